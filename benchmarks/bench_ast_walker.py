@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# Compare the AST walker with the previous recursive walker on large generated templates.
+
+__author__ = 'Petr Ankudinov'
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import jinja2
+import jinja2.nodes
+from modules.j2ASTwalker import J2Meta, value_dict
+
+
+class LegacyJ2Meta(J2Meta):
+    # AST walk as implemented before the dispatch table and the explicit stack
+
+    def j2_ast_walk_main(self, j2node):
+        # The script will start walking over Jinja2 AST here looking for Getattr, Assign, Name, For nodes.
+        result_list = list()
+        recursion_required_nodes = [jinja2.nodes.Template, jinja2.nodes.Output]
+        recursion_required = False
+        for node in recursion_required_nodes:
+            if isinstance(j2node, node):
+                recursion_required = True
+        if recursion_required:
+            for child_node in j2node.iter_child_nodes():
+                # Recursion to get more specific nodes
+                for e in self.j2_ast_walk_main(child_node):
+                    result_list.append(e)
+        else:
+            # Node specific walk
+            if isinstance(j2node, jinja2.nodes.For):
+                for e in self.j2_ast_walk_for(j2node):
+                    result_list.append(e)
+            if isinstance(j2node, jinja2.nodes.If):
+                for e in self.j2_ast_walk_if(j2node):
+                    result_list.append(e)
+            if isinstance(j2node, jinja2.nodes.Getattr):
+                for e in self.j2_ast_walk_getattr(j2node):
+                    result_list.append(e)
+            if isinstance(j2node, jinja2.nodes.Assign):
+                for e in self.j2_ast_walk_assign(j2node):
+                    result_list.append(e)
+            if isinstance(j2node, jinja2.nodes.Name):
+                for e in self.j2_ast_walk_name(j2node):
+                    result_list.append(e)
+            # Ignore following nodes
+            ignored_node_list = [
+                jinja2.nodes.TemplateData,
+                jinja2.nodes.Literal,
+                jinja2.nodes.Expr,
+                jinja2.nodes.Const,
+                jinja2.nodes.Include,
+            ]
+            for ignored_node in ignored_node_list:
+                if isinstance(j2node, ignored_node):
+                    pass  # do nothing
+            # Generate alert for future debugging
+            alert_nodes_list = [
+                jinja2.nodes.Macro,
+                jinja2.nodes.CallBlock,
+                jinja2.nodes.FilterBlock,
+                jinja2.nodes.With,
+                jinja2.nodes.Block,
+                jinja2.nodes.Import,
+                jinja2.nodes.FromImport,
+                jinja2.nodes.ExprStmt,
+                jinja2.nodes.AssignBlock,
+                jinja2.nodes.BinExpr,
+                jinja2.nodes.UnaryExpr,
+                jinja2.nodes.Tuple,
+                jinja2.nodes.List,
+                jinja2.nodes.Dict,
+                jinja2.nodes.Pair,
+                jinja2.nodes.Keyword,
+                jinja2.nodes.CondExpr,
+                jinja2.nodes.Filter,
+                jinja2.nodes.Test,
+                jinja2.nodes.Call,
+                jinja2.nodes.Getitem,
+                jinja2.nodes.Slice,
+                jinja2.nodes.Concat,
+                jinja2.nodes.Compare,
+                jinja2.nodes.Operand,
+            ]
+            for i, ignored_node in enumerate(alert_nodes_list):
+                if isinstance(j2node, ignored_node):
+                    print("Ignoring %s!" % alert_nodes_list[i], file=sys.stderr)
+                    print(j2node, file=sys.stderr)
+
+        return result_list
+
+    def j2_ast_walk_getattr(self, j2node):
+        result_list = list()
+        for child_node in j2node.iter_child_nodes():
+            for e in self.j2_ast_walk_main(child_node):
+                result_list.append(e)
+        for tpl in result_list:
+            tpl[0].append(j2node.attr)  # add parent key to each tuple
+        return result_list
+
+    def j2_ast_walk_for(self, j2node):
+        result_list = list()
+        iter_list = self.j2_ast_walk_main(j2node.iter)
+
+        target_key_list = self.j2_ast_walk_main(j2node.target)  # value will be ignored
+        target_key_length = len(target_key_list)
+
+        target_child_key_list = list()
+        for node in j2node.body:
+            for e in self.j2_ast_walk_main(node):
+                for tk in target_key_list:
+                    if e[0][:target_key_length] == tk[0]:
+                        if e[0][target_key_length:]:  # verify if there are any other key apart from target
+                            target_child_key_list.append((e[0][target_key_length:], e[1]))
+                    else:
+                        result_list.append(e)
+        for ik in iter_list:
+            if target_child_key_list:
+                result_list.append((ik[0], [target_child_key_list, value_dict['list']]))
+            else:
+                result_list.append((ik[0], [ik[1], value_dict['list']]))
+
+        return result_list
+
+    def j2_ast_walk_if(self, j2node):
+        result_list = list()
+
+        if isinstance(j2node.test, jinja2.nodes.Compare):
+            for key_list, value in self.j2_ast_walk_getattr(j2node.test.expr):
+                result_list.append((key_list, value))
+
+        for node in j2node.body:
+            for key_list, value in self.j2_ast_walk_main(node):
+                result_list.append((key_list, value))
+
+        for node in j2node.else_:
+            for key_list, value in self.j2_ast_walk_main(node):
+                result_list.append((key_list, value))
+
+        return result_list
+
+
+def random_expression(rnd, loop_vars, allow_filter=True):
+    # attribute chains over global and loop variables, sometimes with a filter to trigger alerts
+    root = rnd.choice(loop_vars + ['vxlan', 'bgp', 'mlag', 'ntp'])
+    expression = '.'.join([root] + ['attr%d' % rnd.randrange(8) for _ in range(rnd.randrange(4))])
+    if allow_filter and rnd.random() < 0.05:
+        expression += ' | upper'
+    return expression
+
+
+def random_block(rnd, depth, max_depth, loop_vars):
+    lines = list()
+    for _ in range(rnd.randrange(2, 6)):
+        kind = rnd.randrange(10)
+        if kind < 5:
+            lines.append('line {{ %s }} and {{ %s }}' % (random_expression(rnd, loop_vars),
+                                                          random_expression(rnd, loop_vars)))
+        elif kind < 7 and depth < max_depth:
+            loop_var = 'item%d' % depth
+            lines.append('{%% for %s in %s %%}' % (loop_var, random_expression(rnd, loop_vars, allow_filter=False)))
+            lines.extend(random_block(rnd, depth + 1, max_depth, loop_vars + [loop_var]))
+            lines.append('{% endfor %}')
+        elif kind < 9 and depth < max_depth:
+            lines.append('{%% if %s == True %%}' % random_expression(rnd, loop_vars, allow_filter=False))
+            lines.extend(random_block(rnd, depth + 1, max_depth, loop_vars))
+            lines.append('{% else %}')
+            lines.extend(random_block(rnd, depth + 1, max_depth, loop_vars))
+            lines.append('{% endif %}')
+        else:
+            lines.append('{%% set %s = "%d" %%}' % ('local%d' % rnd.randrange(5), rnd.randrange(100)))
+    return lines
+
+
+def generate_template(seed, statements, max_depth):
+    rnd = random.Random(seed)
+    lines = list()
+    while len(lines) < statements:
+        lines.extend(random_block(rnd, 0, max_depth, []))
+    return '\n'.join(lines)
+
+
+def nested_template(depth):
+    # deeply nested loops, the previous walker needs a few Python frames per level
+    source = ''
+    for level in range(depth):
+        source += '{%% for item%d in list%d %%}{{ item%d.name }}' % (level, level, level)
+    return source + '{% endfor %}' * depth
+
+
+def walk(walk_function, parsed_template_list):
+    # walk_function: J2Meta.iter_ast or LegacyJ2Meta.j2_ast_walk_main of a walker instance
+    stderr = io.StringIO()
+    with contextlib.redirect_stderr(stderr):
+        start = time.perf_counter()
+        result_list = [list(walk_function(parsed_template)) for parsed_template in parsed_template_list]
+        walk_time = time.perf_counter() - start
+    return result_list, stderr.getvalue(), walk_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='AST walker benchmark.')
+    parser.add_argument('--templates', type=int, default=20, help='Number of generated templates.')
+    parser.add_argument('--statements', type=int, default=2000, help='Minimum number of lines per template.')
+    parser.add_argument('--depth', type=int, default=6, help='Maximum for/if nesting depth.')
+    parser.add_argument('--nested', type=int, default=600, help='Depth of the deeply nested template.')
+    args = parser.parse_args()
+
+    j2_env = jinja2.Environment()
+    parsed_template_list = [j2_env.parse(generate_template(seed, args.statements, args.depth))
+                            for seed in range(args.templates)]
+    node_count = sum(1 for parsed_template in parsed_template_list for _ in parsed_template.find_all(jinja2.nodes.Node))
+
+    template_meta = J2Meta.__new__(J2Meta)  # walker only, no template files required
+    legacy_meta = LegacyJ2Meta.__new__(LegacyJ2Meta)
+
+    legacy_result, legacy_alerts, legacy_time = walk(legacy_meta.j2_ast_walk_main, parsed_template_list)
+    result, alerts, walk_time = walk(template_meta.iter_ast, parsed_template_list)
+    if result != legacy_result or alerts != legacy_alerts:
+        sys.exit('ERROR: Walker output is different!')
+
+    print('templates: %d, nodes: %d' % (args.templates, node_count))
+    print('previous walker: %.3f s, %.2f us per node' % (legacy_time, legacy_time / node_count * 1e6))
+    print('walker:          %.3f s, %.2f us per node' % (walk_time, walk_time / node_count * 1e6))
+
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, args.nested * 20))  # Jinja2 parser is recursive
+    nested = [j2_env.parse(nested_template(args.nested))]
+    sys.setrecursionlimit(recursion_limit)
+    try:
+        walk(legacy_meta.j2_ast_walk_main, nested)
+    except RecursionError:
+        print('previous walker: RecursionError at nesting depth %d' % args.nested)
+    else:
+        print('previous walker: nesting depth %d walked' % args.nested)
+    walk(template_meta.iter_ast, nested)
+    print('walker:          nesting depth %d walked' % args.nested)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Build, update and query the dependency index for a large fleet.
+
+__author__ = 'Petr Ankudinov'
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from benchmarks import synth
+from benchmarks.synth import timed
+from benchmarks.run import BenchEnvironment, REPO_TEMPLATES
+from modules.depindex import DependencyIndex
+
+
+def update(env, work_dir):
+    index = DependencyIndex(work_dir, env.filename, env.template_path)
+    if index.update(env):
+        index.save()
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dependency index benchmark.')
+    parser.add_argument('--hosts', type=int, default=50000, help='Number of hosts.')
+    parser.add_argument('--blocks', type=int, default=300, help='Number of task blocks.')
+    parser.add_argument('--queries', type=int, default=100, help='Number of timed queries.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        template_dir = os.path.join(work_dir, 'templates')
+        shutil.copytree(REPO_TEMPLATES, template_dir)
+        env = BenchEnvironment(synth.host_db(args.hosts), synth.task(args.blocks), template_dir)
+        # the index checks host db and task files for changes
+        env.db_name = os.path.join(work_dir, 'db.json')
+        env.filename = os.path.join(work_dir, 'task.json')
+        for filename, data in [(env.db_name, env.json_db.to_dict()), (env.filename, env.json_data)]:
+            with open(filename, mode='w') as file:
+                json.dump(data, file)
+
+        index, build_time = timed(lambda: update(env, work_dir))
+        _, noop_time = timed(lambda: update(env, work_dir))
+        os.utime(os.path.join(template_dir, 'vxlan.j2'))
+        index, template_time = timed(lambda: update(env, work_dir))
+        if index.updated['templates'] != 1 or index.updated['classes'] or index.updated['blocks']:
+            sys.exit('ERROR: Changed template was not updated incrementally!')
+        variables = [block for block in env.json_data if 'variables' in block][0]['variables']
+        variables['vxlan']['loopback']['mask'] = 31
+        with open(env.filename, mode='w') as file:
+            json.dump(env.json_data, file)
+        index, block_time = timed(lambda: update(env, work_dir))
+        if index.updated['blocks'] != 1 or index.updated['classes']:
+            sys.exit('ERROR: Changed task block was not updated incrementally!')
+        index, load_time = timed(lambda: DependencyIndex(work_dir, env.filename, env.template_path))
+        index_size = os.path.getsize(index.realpath)
+
+        template_hosts, template_query_time = timed(lambda: [index.template_hosts('vxlan.j2')
+                                                             for _ in range(args.queries)])
+        variable_hosts, variable_query_time = timed(lambda: [index.variable_hosts('vxlan.loopback.mask')
+                                                             for _ in range(args.queries)])
+        block_hosts, block_query_time = timed(lambda: [index.variable_hosts('vlan_list[].vni')
+                                                       for _ in range(args.queries)])
+
+    print(', '.join('%s: %d' % e for e in sorted(index.stats().items())))
+    print('%-44s %10.3f s' % ('full build:', build_time))
+    print('%-44s %10.3f s' % ('update, nothing changed:', noop_time))
+    print('%-44s %10.3f s' % ('update, vxlan.j2 changed:', template_time))
+    print('%-44s %10.3f s' % ('update, one task block changed:', block_time))
+    print('%-44s %10.3f s' % ('load, %.1f MiB:' % (index_size / 2 ** 20), load_time))
+    print('%-44s %10.3f ms' % ('query vxlan.j2, %d host(s):' % len(template_hosts[0]),
+                               template_query_time / args.queries * 1000))
+    print('%-44s %10.3f ms' % ('query vxlan.loopback.mask, %d host(s):' % len(variable_hosts[0]),
+                               variable_query_time / args.queries * 1000))
+    print('%-44s %10.3f ms' % ('query vlan_list[].vni, %d host(s):' % len(block_hosts[0]),
+                               block_query_time / args.queries * 1000))
+
+
+if __name__ == '__main__':
+    main()
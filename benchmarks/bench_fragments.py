@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Compare ways to assemble a host config from many rendered template fragments.
+
+__author__ = 'Petr Ankudinov'
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from modules import delivery
+from modules.j2cache import TemplateCache
+
+TEMPLATE = '''{%- for vlan in vlan_list %}
+vlan {{ vlan.number }}
+  name {{ vlan.name }}
+{%- endfor %}
+'''
+
+
+def concatenate(fragments):
+    # config assembly as implemented before fragments were joined once
+    configuration = ''
+    for config in fragments:
+        configuration = configuration + '\n' + config
+    return configuration
+
+
+def join(fragments):
+    result = list()
+    for config in fragments:
+        result.append('\n')
+        result.append(config)
+    return ''.join(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Config fragment assembly benchmark.')
+    parser.add_argument('--hosts', type=int, default=200, help='Number of hosts.')
+    parser.add_argument('--fragments', type=int, default=200, help='Number of template fragments per host.')
+    parser.add_argument('--vlans', type=int, default=50, help='Number of VLANs rendered by every fragment.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with open(os.path.join(tmp_dir, 'vlan.j2'), mode='w') as file:
+            file.write(TEMPLATE)
+        variables = {'vlan_list': [{'number': i, 'name': 'vlan_%d' % i} for i in range(args.vlans)]}
+        template_cache = TemplateCache()
+        host_task = [(tmp_dir, 'vlan.j2', variables)] * args.fragments
+        fragments = [template_cache.get_template(tmp_dir, 'vlan.j2').render(variables)] * args.fragments
+
+        start = time.perf_counter()
+        for _ in range(args.hosts):
+            concatenated = concatenate(fragments)
+        concatenate_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(args.hosts):
+            joined = join(fragments)
+        join_time = time.perf_counter() - start
+
+        if concatenated != joined:
+            sys.exit('ERROR: Joined config is different!')
+
+        start = time.perf_counter()
+        for _ in range(args.hosts):
+            rendered = delivery.render_host(template_cache, host_task)
+        render_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        streamed_file = os.path.join(tmp_dir, 'streamed.txt')
+        for _ in range(args.hosts):
+            with open(streamed_file, mode='w') as file:
+                delivery.write_host(template_cache, host_task, file)
+        stream_time = time.perf_counter() - start
+
+        with open(streamed_file, mode='r') as file:
+            if file.read() != rendered:
+                sys.exit('ERROR: Streamed config is different!')
+
+    print('hosts: %d, fragments per host: %d, config size: %d bytes' % (args.hosts, args.fragments, len(joined)))
+    print('assembly, concatenation: %.3f s' % concatenate_time)
+    print('assembly, join:          %.3f s' % join_time)
+    print('render_host (render + join):   %.3f s' % render_time)
+    print('write_host (generate to file): %.3f s' % stream_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Compare per host variable merging and rendering with merging and rendering once per host class.
+
+__author__ = 'Petr Ankudinov'
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from benchmarks import synth
+from benchmarks.synth import timed
+from benchmarks.run import BenchEnvironment, REPO_TEMPLATES
+from modules import tools, delivery
+
+
+def legacy_build_host_tasks(env):
+    # previous implementation: variables are merged for every host separately
+    db = env.json_db
+    json_data = env.json_data
+    variables = dict()
+    owned = set()
+    host_tasks = dict()
+    for block in json_data:
+        if 'variables' in block.keys():
+            for host in db.match(block['tags']):
+                try:
+                    variables[host]
+                except:
+                    variables[host] = block['variables']
+                else:
+                    if host in owned:
+                        tools.merge_dict(variables[host], block['variables'], in_place=True)
+                    else:
+                        variables[host] = tools.merge_dict(variables[host], block['variables'])
+                        owned.add(host)
+        if 'templates' in block.keys():
+            locations = [delivery.template_location(env.template_path, j2) for j2 in block['templates']]
+            for host in db.match(block['tags']):
+                try:
+                    host_tasks[host]
+                except:
+                    host_tasks[host] = list()
+                for template_search_path, template_filename in locations:
+                    host_tasks[host].append((template_search_path, template_filename, variables.get(host)))
+                owned.discard(host)
+    return host_tasks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Host class benchmark.')
+    parser.add_argument('--hosts', type=int, default=10000, help='Number of hosts.')
+    parser.add_argument('--blocks', type=int, default=300, help='Number of task blocks.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        template_dir = os.path.join(work_dir, 'templates')
+        shutil.copytree(REPO_TEMPLATES, template_dir)
+        env = BenchEnvironment(synth.host_db(args.hosts), synth.task(args.blocks), template_dir)
+
+        legacy_tasks, legacy_merge_time = timed(lambda: legacy_build_host_tasks(env))
+        host_tasks, merge_time = timed(lambda: delivery.build_host_tasks(env))
+        legacy_configs, legacy_render_time = timed(
+            lambda: {host: configuration for host, configuration, _ in
+                     delivery.iter_configs(env, host_tasks=legacy_tasks, render_each=True)})
+        configs, render_time = timed(
+            lambda: {host: configuration for host, configuration, _ in delivery.iter_configs(env, host_tasks=host_tasks)})
+
+    if legacy_tasks != host_tasks or legacy_configs != configs:
+        sys.exit('ERROR: Host classes changed the result!')
+    classes = len(set(id(host_task) for host_task in host_tasks.values()))
+    print('hosts: %d, task blocks: %d, host classes: %d' % (len(host_tasks), args.blocks, classes))
+    print('%-36s %8.3f s' % ('merge per host:', legacy_merge_time))
+    print('%-36s %8.3f s' % ('merge per class:', merge_time))
+    print('%-36s %8.3f s' % ('render per host:', legacy_render_time))
+    print('%-36s %8.3f s' % ('render per class:', render_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Compare HostDB with the dictionary of tag lists: memory, host selection and per host tag checks.
+
+__author__ = 'Petr Ankudinov'
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from benchmarks import synth
+from benchmarks.synth import timed
+from benchmarks.bench_tag_index import synthetic_blocks, scan, build_tag_index, match_hosts
+from modules import tools
+from modules.hostdb import HostDB
+
+
+def load_db(host_count):
+    # load the db from YAML, so every tag is a separate string object like in a real run
+    with tempfile.TemporaryDirectory() as work_dir:
+        db_file = os.path.join(work_dir, 'db.yaml')
+        with open(db_file, mode='w') as file:
+            for host, tags in synth.host_db(host_count).items():
+                file.write('%s: [%s]\n' % (host, ', '.join(tags)))
+        return tools.load_yaml(db_file)
+
+
+def traced(function):
+    # result of the function and memory allocated by it that is still in use
+    gc.collect()
+    tracemalloc.start()
+    result = function()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HostDB benchmark.')
+    parser.add_argument('--hosts', type=int, default=100000, help='Number of hosts.')
+    parser.add_argument('--blocks', type=int, default=500, help='Number of task blocks.')
+    parser.add_argument('--scan-blocks', type=int, default=10, help='Number of blocks for the full scan.',
+                        dest='scan_blocks')
+    args = parser.parse_args()
+
+    json_db, dict_size = traced(lambda: load_db(args.hosts))
+    tag_index, index_size = traced(lambda: build_tag_index(json_db))
+    host_db, host_db_size = traced(lambda: HostDB(load_db(args.hosts)))  # without the source dictionary
+    blocks = synthetic_blocks(args.blocks, args.hosts)
+
+    scan_result, scan_time = timed(lambda: scan(json_db, blocks[:args.scan_blocks]))
+    index_result, index_time = timed(lambda: [match_hosts(json_db, tag_index, block['tags'])
+                                              for block in blocks])
+    bitset_result, bitset_time = timed(lambda: [host_db.match(block['tags']) for block in blocks])
+    if [set(hosts) for hosts in bitset_result] != index_result or index_result[:args.scan_blocks] != scan_result:
+        sys.exit('ERROR: HostDB returned different hosts!')
+    if host_db.to_dict() != {host: sorted(set(tags), key=host_db.tag_ids.get) for host, tags in json_db.items()}:
+        sys.exit('ERROR: HostDB tags are different!')
+
+    tags = ['switch', 'any']
+    subset_result, subset_time = timed(lambda: [set(tags).issubset(set(json_db[host])) for host in json_db])
+    mask, rare = host_db.split_tags(tags)  # tag set is converted once, then checked with a bitwise AND per host
+    mask_result, mask_time = timed(lambda: [host_db.host_has(number, mask, rare) for number in range(len(host_db))])
+    if subset_result != mask_result:
+        sys.exit('ERROR: Bitmask check is different!')
+
+    print('hosts: %d, blocks: %d, tags: %d' % (args.hosts, args.blocks, len(host_db.tags)))
+    print('%-44s %10.1f MiB' % ('memory, dict of tag lists:', dict_size / 2 ** 20))
+    print('%-44s %10.1f MiB' % ('memory, dict of tag lists and tag index:', (dict_size + index_size) / 2 ** 20))
+    print('%-44s %10.1f MiB' % ('memory, HostDB:', host_db_size / 2 ** 20))
+    print('%-44s %10.3f ms' % ('match per block, scan with sets:', scan_time / args.scan_blocks * 1000))
+    print('%-44s %10.3f ms' % ('match per block, tag index:', index_time / args.blocks * 1000))
+    print('%-44s %10.3f ms' % ('match per block, HostDB:', bitset_time / args.blocks * 1000))
+    print('%-44s %10.3f ms' % ('issubset for every host, sets:', subset_time * 1000))
+    print('%-44s %10.3f ms' % ('issubset for every host, bitmasks:', mask_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# Compare ScriptEnvironment construction with pure Python YAML loader, libyaml loader and parsed data cache.
+
+__author__ = 'Petr Ankudinov'
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import yaml
+import j2p
+from benchmarks import synth
+from modules import tools
+
+
+def write_inputs(work_dir, host_count, block_count):
+    for directory in ['templates', 'tasks', 'generated_configs']:
+        os.makedirs(os.path.join(work_dir, directory))
+    with open(os.path.join(work_dir, 'db.yaml'), mode='w') as file:
+        for host, tags in synth.host_db(host_count).items():
+            file.write('%s: [%s]\n' % (host, ', '.join(tags)))
+    with open(os.path.join(work_dir, 'tasks', 'task.yaml'), mode='w') as file:
+        yaml.dump(synth.task(block_count), file, default_flow_style=False)
+    for cache in [False, True]:
+        with open(os.path.join(work_dir, 'settings_cache.yaml' if cache else 'settings.yaml'), mode='w') as file:
+            file.write('template_path: ./templates\ntask_path: ./tasks\nconfigs: ./generated_configs\n'
+                       'host_db: ./db.yaml\n')
+            if cache:
+                file.write('yaml_cache: ./.yaml_cache\n')
+
+
+def script_environment(settings_file):
+    start = time.perf_counter()
+    env = j2p.ScriptEnvironment(j2p.ArgParser(['task.yaml', 'yaml', 'save']), settings_file=settings_file)
+    elapsed = time.perf_counter() - start
+    return env, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='YAML loading benchmark.')
+    parser.add_argument('--hosts', type=int, default=100000, help='Number of hosts in the db.')
+    parser.add_argument('--blocks', type=int, default=300, help='Number of task blocks.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        write_inputs(work_dir, args.hosts, args.blocks)
+        os.chdir(work_dir)
+
+        loader = tools.YAMLLoader
+        tools.YAMLLoader = yaml.SafeLoader
+        python_env, python_time = script_environment('settings.yaml')
+        tools.YAMLLoader = loader
+        libyaml_env, libyaml_time = script_environment('settings.yaml')
+        script_environment('settings_cache.yaml')  # fill the cache
+        cached_env, cached_time = script_environment('settings_cache.yaml')
+
+        for env in [libyaml_env, cached_env]:
+            if env.json_db != python_env.json_db or env.json_data != python_env.json_data:
+                sys.exit('ERROR: Loaded data is different!')
+
+    print('hosts: %d, task blocks: %d, libyaml available: %s' % (args.hosts, args.blocks, yaml.__with_libyaml__))
+    print('%-40s %8.3f s' % ('ScriptEnvironment, SafeLoader:', python_time))
+    print('%-40s %8.3f s' % ('ScriptEnvironment, %s:' % loader.__name__, libyaml_time))
+    print('%-40s %8.3f s' % ('ScriptEnvironment, parsed data cache:', cached_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# Compare merge_dict with the previous recursive implementation and check that merge results are identical.
+
+__author__ = 'Petr Ankudinov'
+
+from collections import Counter
+import argparse
+import copy
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from modules import tools
+
+
+def legacy_merge_dict(d1, d2):
+    # merge_dict as implemented before the iterative version
+    result = dict()
+    all_keys = set(d1.keys()).union(d2.keys())
+    for key in all_keys:
+        if key not in d1.keys():
+            result[key] = d2[key]
+        elif key not in d2.keys():
+            result[key] = d1[key]
+        else:
+            if isinstance(d1[key], dict) and isinstance(d2[key], dict):
+                    result[key] = legacy_merge_dict(d1[key], d2[key])
+            elif isinstance(d1[key], list) or isinstance(d2[key], list):
+                temp_set = set()
+                temp_dict = dict()
+
+                if isinstance(d1[key], dict):
+                    temp_dict = legacy_merge_dict(temp_dict, d1[key])
+                if isinstance(d2[key], dict):
+                    temp_dict = legacy_merge_dict(temp_dict, d2[key])
+
+                if isinstance(d1[key], list):
+                    for e1 in d1[key]:
+                        if isinstance(e1, dict):
+                            temp_dict = legacy_merge_dict(temp_dict, e1)
+                        else:
+                            temp_set.add(e1)
+
+                if isinstance(d2[key], list):
+                    for e2 in d2[key]:
+                        if isinstance(e2, dict):
+                            temp_dict = legacy_merge_dict(temp_dict, e2)
+                        else:
+                            temp_set.add(e2)
+
+                result[key] = list()
+                result[key].append(temp_dict)
+                for e in temp_set:
+                    result[key].append(e)
+            else:
+                result[key] = d2[key]
+
+    return result
+
+
+def canonical(value):
+    # the previous implementation kept unique list scalars in set order, so scalars are compared as a multiset
+    if isinstance(value, dict):
+        return {key: canonical(e) for key, e in value.items()}
+    if isinstance(value, list):
+        return ([canonical(e) for e in value if isinstance(e, dict)],
+                Counter(e for e in value if not isinstance(e, dict)))
+    return value
+
+
+def random_value(rnd, depth):
+    kind = rnd.randrange(6) if depth > 0 else rnd.randrange(3)
+    if kind == 0:
+        return rnd.randrange(5)
+    if kind == 1:
+        return rnd.choice(['a', 'b', 'c', None, True])
+    if kind == 2:
+        return 'value%d' % rnd.randrange(3)
+    if kind in (3, 4):
+        return random_dict(rnd, depth - 1)
+    return [random_dict(rnd, depth - 1) if rnd.random() < 0.3 else random_value(rnd, 0)
+            for _ in range(rnd.randrange(4))]
+
+
+def random_dict(rnd, depth):
+    return {rnd.choice('abcdef'): random_value(rnd, depth) for _ in range(rnd.randrange(5))}
+
+
+def check_semantics(cases, seed=0):
+    # randomized property check: same result as the previous implementation, inputs are never modified,
+    # list scalars keep the order of appearance
+    rnd = random.Random(seed)
+    for case in range(cases):
+        d1 = random_dict(rnd, 4)
+        d2 = random_dict(rnd, 4)
+        d1_copy, d2_copy = copy.deepcopy(d1), copy.deepcopy(d2)
+        expected = canonical(legacy_merge_dict(d1, d2))
+        merged = tools.merge_dict(d1, d2)
+        if canonical(merged) != expected:
+            sys.exit('ERROR: merge_dict result is different for case %d!' % case)
+        if tools.merge_dict(copy.deepcopy(d1), copy.deepcopy(d2)) != merged:
+            sys.exit('ERROR: merge_dict list order is not deterministic for case %d!' % case)
+        if d1 != d1_copy or d2 != d2_copy:
+            sys.exit('ERROR: merge_dict modified input for case %d!' % case)
+        accumulator = dict(d1)
+        if tools.merge_dict(accumulator, d2, in_place=True) != merged or accumulator != merged:
+            sys.exit('ERROR: in-place merge_dict result is different for case %d!' % case)
+        if d1 != d1_copy or d2 != d2_copy:
+            sys.exit('ERROR: in-place merge_dict modified input for case %d!' % case)
+        # accumulator owning nested dictionaries: d3 is merged in place, d1 and d2 are still shared and never modified
+        d3 = random_dict(rnd, 4)
+        d3_copy = copy.deepcopy(d3)
+        expected = tools.merge_dict(merged, d3)
+        owned = dict()
+        accumulator = tools.merge_dict(d1, d2, owned=owned)
+        tools.merge_dict(accumulator, d3, in_place=True, owned=owned)
+        if accumulator != expected:
+            sys.exit('ERROR: owned in-place merge_dict result is different for case %d!' % case)
+        if d1 != d1_copy or d2 != d2_copy or d3 != d3_copy:
+            sys.exit('ERROR: owned in-place merge_dict modified input for case %d!' % case)
+
+
+def variable_block(block_number, vlans, depth):
+    # deep and wide variable tree similar to a task block
+    nested = {'value': block_number}
+    for level in range(depth):
+        nested = {'level%d' % level: nested, 'shared%d' % level: {'key': level}}
+    return {
+        'vlans': {vlan: {'name': 'vlan_%d' % vlan, 'vni': '0.0.%d' % vlan, 'block': block_number}
+                  for vlan in range(block_number, block_number + vlans)},
+        'vlan_list': [{'number': vlan} for vlan in range(block_number % 10)] + ['vlan%d' % block_number],
+        'nested': nested,
+        'block%d' % block_number: True,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='merge_dict benchmark.')
+    parser.add_argument('--blocks', type=int, default=50, help='Number of variable blocks merged for a host.')
+    parser.add_argument('--vlans', type=int, default=2000, help='Number of VLANs in every block.')
+    parser.add_argument('--depth', type=int, default=50, help='Nesting depth of every block.')
+    parser.add_argument('--cases', type=int, default=5000, help='Number of randomized semantics checks.')
+    args = parser.parse_args()
+
+    check_semantics(args.cases)
+    print('semantics: %d random cases identical to the previous implementation' % args.cases)
+
+    blocks = [variable_block(i, args.vlans, args.depth) for i in range(args.blocks)]
+
+    start = time.perf_counter()
+    legacy = dict()
+    for block in blocks:
+        legacy = legacy_merge_dict(legacy, block)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    merged = dict()
+    for block in blocks:
+        merged = tools.merge_dict(merged, block)
+    merge_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    accumulated = dict()
+    owned = dict()
+    for block in blocks:
+        tools.merge_dict(accumulated, block, in_place=True, owned=owned)
+    in_place_time = time.perf_counter() - start
+
+    if not canonical(legacy) == canonical(merged) or not merged == accumulated:
+        sys.exit('ERROR: Merged variables are different!')
+
+    print('blocks: %d, VLANs per block: %d, depth: %d' % (args.blocks, args.vlans, args.depth))
+    print('previous merge_dict: %.3f s' % legacy_time)
+    print('merge_dict:          %.3f s' % merge_time)
+    print('merge_dict in place: %.3f s' % in_place_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Config output: a new file per host on every run compared with skipping unchanged configs and a single bundle.
+
+__author__ = 'Petr Ankudinov'
+
+import argparse
+import os
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.synth import timed
+from modules import tools
+from modules.output import ConfigWriter, BundleWriter
+
+
+def legacy_write(configs_path, configs):
+    # previous implementation: plain open() of a new timestamped file for every host
+    for host, configuration in configs:
+        realpath = os.path.join(configs_path, str(host) + '_' + str(tools.time_stamp()) + '.txt')
+        file = open(realpath, mode='w')
+        file.write(configuration)
+        file.close()
+
+
+def run_writer(writer, configs):
+    for host, configuration in configs:
+        writer.write(host, configuration)
+    writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Config output benchmark.')
+    parser.add_argument('--hosts', type=int, default=10000, help='Number of host configs.')
+    parser.add_argument('--size', type=int, default=20000, help='Config size in bytes.')
+    parser.add_argument('--changed', type=float, default=0.05, help='Share of configs changed between runs.')
+    args = parser.parse_args()
+
+    line = 'interface Ethernet1\n   description uplink\n'
+    configs = [('host%d' % i, line * (args.size // len(line))) for i in range(args.hosts)]
+    changed_configs = [(host, configuration + ('!\n' if i < args.hosts * args.changed else ''))
+                       for i, (host, configuration) in enumerate(configs)]
+
+    with tempfile.TemporaryDirectory() as legacy_dir, tempfile.TemporaryDirectory() as configs_dir, \
+            tempfile.TemporaryDirectory() as bundle_dir:
+        _, legacy_time = timed(lambda: legacy_write(legacy_dir, changed_configs))
+        run_writer(ConfigWriter(configs_dir), configs)
+        writer = ConfigWriter(configs_dir)
+        _, skip_time = timed(lambda: run_writer(writer, changed_configs))
+        _, bundle_time = timed(lambda: run_writer(BundleWriter(bundle_dir, bundle_format='jsonl'), changed_configs))
+
+    print('hosts: %d, config size: %d bytes, changed: %d%%' % (args.hosts, args.size, args.changed * 100))
+    print('%-40s %8.3f s' % ('new file per host:', legacy_time))
+    print('%-40s %8.3f s (%d written, %d unchanged)' % ('skip unchanged, atomic rename:', skip_time,
+                                                        writer.written, writer.unchanged))
+    print('%-40s %8.3f s' % ('JSON lines bundle:', bundle_time))
+
+
+if __name__ == '__main__':
+    main()
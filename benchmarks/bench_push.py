@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Push engine against a local fake eAPI server: serial push compared with concurrent push.
+# Every host is a separate loopback address, the server answers after a fixed delay and can drop connections.
+
+__author__ = 'Petr Ankudinov'
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from modules import push
+
+
+class FakeEAPIServer:
+    # HTTP/1.1 keep-alive server answering runCmds requests like a switch
+
+    def __init__(self, delay, drop_rate):
+        self.delay = delay
+        self.drop_rate = drop_rate
+        self.connections = 0
+        self.requests = 0
+        self.dropped = 0
+        self.commands = dict()  # host address: list of received commands
+        self.loop = asyncio.new_event_loop()
+        self.port = None
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        host = writer.get_extra_info('sockname')[0]
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                request = json.loads(await reader.readexactly(int(headers['content-length'])))
+                self.requests += 1
+                await asyncio.sleep(self.delay)
+                if random.random() < self.drop_rate:
+                    self.dropped += 1
+                    break
+                commands = request['params']['cmds']
+                if 'invalid' in commands:
+                    response = {'jsonrpc': '2.0', 'id': request['id'],
+                                'error': {'code': 1002, 'message': 'CLI command 3 of 4 \'invalid\' failed'}}
+                else:
+                    self.commands.setdefault(host, list()).extend(commands)
+                    response = {'jsonrpc': '2.0', 'id': request['id'], 'result': [dict() for _ in commands]}
+                body = json.dumps(response).encode()
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+                             % len(body) + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        writer.close()
+
+    def start(self):
+        server = self.loop.run_until_complete(asyncio.start_server(self.handle, '0.0.0.0', 0, backlog=1024))
+        self.port = server.sockets[0].getsockname()[1]
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def reset(self):
+        self.connections = self.requests = self.dropped = 0
+        self.commands = dict()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Push engine benchmark.')
+    parser.add_argument('--hosts', type=int, default=300, help='Number of hosts.')
+    parser.add_argument('--delay', type=float, default=0.02, help='Server response delay, s.')
+    parser.add_argument('--drop-rate', type=float, default=0.05, help='Probability to drop a connection.',
+                        dest='drop_rate')
+    parser.add_argument('--concurrency', type=int, default=200, help='Concurrency of the parallel run.')
+    args = parser.parse_args()
+
+    server = FakeEAPIServer(args.delay, args.drop_rate)
+    server.start()
+    hosts = ['127.0.%d.%d' % (i // 250, i % 250 + 1) for i in range(args.hosts)]
+    configuration = '\n'.join('vlan %d\n   name vlan_%d\n!' % (vlan, vlan) for vlan in range(1, 51))
+    configs = [(host, configuration) for host in hosts]
+    settings = {'https': False, 'port': server.port, 'backoff': 0.01, 'retries': 5,
+                'commit_commands': ['copy running-config startup-config']}
+
+    for concurrency in [1, args.concurrency]:
+        server.reset()
+        start = time.perf_counter()
+        result_list = push.PushEngine(dict(settings, concurrency=concurrency)).run(configs)
+        elapsed = time.perf_counter() - start
+        failed = [result for result in result_list if not result['ok']]
+        delivered = sum(1 for commands in server.commands.values() if 'vlan 50' in commands)
+        print('concurrency %4d: %8.3f s, %d ok, %d failed, %d delivered, %d requests over '
+              '%d connections, %d dropped' % (concurrency, elapsed, len(result_list) - len(failed), len(failed),
+                                              delivered, server.requests, server.connections, server.dropped))
+
+    result_list = push.PushEngine(settings).run([(hosts[0], 'invalid')])
+    print('rejected config: ok=%(ok)s, attempts=%(attempts)d, error=%(error)s' % result_list[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Single host render latency: new j2p.py process for every request compared with the render service.
+
+__author__ = 'Petr Ankudinov'
+
+import argparse
+import http.client
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import yaml
+from benchmarks import synth
+
+
+def write_inputs(work_dir, host_count, block_count):
+    shutil.copytree(os.path.join(REPO_DIR, 'templates'), os.path.join(work_dir, 'templates'))
+    for directory in ['tasks', 'generated_configs']:
+        os.makedirs(os.path.join(work_dir, directory))
+    json_db = synth.host_db(host_count)
+    with open(os.path.join(work_dir, 'db.yaml'), mode='w') as file:
+        for host, tags in json_db.items():
+            file.write('%s: [%s]\n' % (host, ', '.join(tags)))
+    with open(os.path.join(work_dir, 'tasks', 'task.yaml'), mode='w') as file:
+        yaml.dump(synth.task(block_count), file, default_flow_style=False)
+    with open(os.path.join(work_dir, 'settings.yaml'), mode='w') as file:
+        file.write('template_path: ./templates\ntask_path: ./tasks\nconfigs: ./generated_configs\nhost_db: ./db.yaml\n')
+    return sorted(json_db)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render service latency benchmark.')
+    parser.add_argument('--hosts', type=int, default=1000, help='Number of hosts in the db.')
+    parser.add_argument('--blocks', type=int, default=300, help='Number of task blocks.')
+    parser.add_argument('--requests', type=int, default=2000, help='Number of render requests to the service.')
+    args = parser.parse_args()
+
+    j2p = os.path.join(REPO_DIR, 'j2p.py')
+    with tempfile.TemporaryDirectory() as work_dir:
+        hosts = write_inputs(work_dir, args.hosts, args.blocks)
+
+        start = time.perf_counter()
+        subprocess.run([sys.executable, j2p, 'task.yaml', 'yaml', 'save'], cwd=work_dir, check=True)
+        process_time = time.perf_counter() - start
+
+        port = free_port()
+        server = subprocess.Popen([sys.executable, j2p, 'task.yaml', 'yaml', 'serve', '-b', '127.0.0.1:%d' % port],
+                                  cwd=work_dir, stderr=subprocess.PIPE, universal_newlines=True)
+        try:
+            print(server.stderr.readline().strip())
+            connection = http.client.HTTPConnection('127.0.0.1', port)
+            latency = list()
+            for i in range(args.requests):
+                start = time.perf_counter()
+                connection.request('GET', '/render/' + hosts[i % len(hosts)])
+                response = connection.getresponse()
+                body = response.read()
+                latency.append(time.perf_counter() - start)
+                if response.status != 200 or not body:
+                    sys.exit('ERROR: Render request failed with %d!' % response.status)
+            connection.close()
+        finally:
+            server.terminate()
+            server.wait()
+
+    print('hosts: %d, task blocks: %d' % (args.hosts, args.blocks))
+    print('%-40s %10.2f ms' % ('j2p.py process, all hosts:', process_time * 1000))
+    print('%-40s %10.2f ms' % ('service, single host, p50:', percentile(latency, 50) * 1000))
+    print('%-40s %10.2f ms' % ('service, single host, p99:', percentile(latency, 99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# Cold start of the j2p.py CLI: wall time of complete runs and import time reported by python -X importtime.
+
+__author__ = 'Petr Ankudinov'
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks import synth
+
+# mode name: j2p.py arguments
+MODES = {
+    'j2': ['vlan.j2', 'j2'],
+    'save': ['test-task.yaml', 'yaml', 'save', '-f'],
+}
+
+
+def copy_repo(work_dir, host_count):
+    # script, modules and inputs only, configs are written to the copy
+    repo_dir = os.path.join(work_dir, 'repo')
+    os.makedirs(os.path.join(repo_dir, 'generated_configs'))
+    for name in ['modules', 'templates', 'tasks']:
+        shutil.copytree(os.path.join(REPO_DIR, name), os.path.join(repo_dir, name),
+                        ignore=shutil.ignore_patterns('__pycache__'))
+    for name in ['j2p.py', 'db.yaml', 'settings.yaml']:
+        shutil.copy(os.path.join(REPO_DIR, name), repo_dir)
+    if host_count:
+        # synthetic hosts and tags are added to the repo db with a prefix, the task still matches the same hosts
+        with open(os.path.join(repo_dir, 'db.yaml'), mode='a') as file:
+            file.write('\n')
+            for host, tags in synth.host_db(host_count).items():
+                file.write('bench_%s: [%s]\n' % (host, ', '.join('bench_' + tag for tag in tags)))
+    subprocess.run([sys.executable, '-m', 'compileall', '-q', repo_dir], check=True)  # bytecode is not measured
+    return repo_dir
+
+
+def run_cli(repo_dir, arguments, options=()):
+    # returns wall time and stderr of a single run
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable] + list(options) + ['j2p.py'] + arguments, cwd=repo_dir,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode:
+        raise Exception('j2p.py %s failed: %s' % (' '.join(arguments), result.stderr.strip()))
+    return elapsed, result.stderr
+
+
+def parse_importtime(stderr):
+    """
+    Parse python -X importtime output.
+    :param stderr: Output of the interpreter.
+    :return: Tuple with a list of (module, self time, cumulative time) tuples in microseconds for top level imports
+    and the number of imported modules.
+    """
+    top_level = list()
+    count = 0
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        count += 1
+        if not name[1:].startswith(' '):  # nested imports are indented
+            top_level.append((name.strip(), int(self_time), int(cumulative)))
+    return top_level, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='j2p.py startup benchmark.')
+    parser.add_argument('--modes', default=','.join(MODES), help='Comma separated modes to run.')
+    parser.add_argument('--runs', type=int, default=10, help='Number of timed runs of every mode.')
+    parser.add_argument('--hosts', type=int, default=0, help='Number of synthetic hosts added to the host db.')
+    parser.add_argument('--top', type=int, default=8, help='Number of the slowest top level imports to print.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        repo_dir = copy_repo(work_dir, args.hosts)
+        run_cli(repo_dir, ['--help'])  # warm up the file system cache
+        for mode in args.modes.split(','):
+            arguments = MODES[mode]
+            times = [run_cli(repo_dir, arguments)[0] for _ in range(args.runs)]
+            top_level, count = parse_importtime(run_cli(repo_dir, arguments, options=['-X', 'importtime'])[1])
+            # site is imported by every interpreter, the rest is imported by j2p.py
+            imports = sum(cumulative for name, _, cumulative in top_level if name not in ['site', 'encodings'])
+            print('%s: %s' % (mode, ' '.join(arguments)))
+            print('  %-40s %8.1f ms' % ('wall time, median of %d runs:' % args.runs, statistics.median(times) * 1000))
+            print('  %-40s %8.1f ms' % ('wall time, best run:', min(times) * 1000))
+            print('  %-40s %8.1f ms' % ('imports, %d modules:' % count, imports / 1000))
+            for name, _, cumulative in sorted(top_level, key=lambda e: -e[2])[:args.top]:
+                print('    %-38s %8.1f ms' % (name, cumulative / 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# Compare host selection with a full db scan and with the inverted tag index.
+
+__author__ = 'Petr Ankudinov'
+
+import argparse
+import random
+import sys
+import time
+
+
+def synthetic_db(host_count, seed=0):
+    rnd = random.Random(seed)
+    db = dict()
+    for i in range(host_count):
+        host = 'leaf%d' % i
+        db[host] = [host, 'site%d' % rnd.randrange(20), 'pod%d' % rnd.randrange(200),
+                    'mlag%d' % (i // 2), rnd.choice(['switch', 'router']), 'any']
+    return db
+
+
+def synthetic_blocks(block_count, host_count, seed=0):
+    rnd = random.Random(seed)
+    blocks = list()
+    for _ in range(block_count):
+        kind = rnd.randrange(4)
+        if kind == 0:
+            tags = ['mlag%d' % rnd.randrange(host_count // 2)]
+        elif kind == 1:
+            tags = ['site%d' % rnd.randrange(20), 'switch']
+        elif kind == 2:
+            tags = ['pod%d' % rnd.randrange(200), 'any']
+        else:
+            tags = ['leaf%d' % rnd.randrange(host_count), 'any']
+        blocks.append({'tags': tags})
+    return blocks
+
+
+def build_tag_index(db):
+    """
+    Build an inverted index of the host database.
+    Dictionary based tag index used before HostDB, kept as a reference for the benchmarks.
+    :param db: Host database. Dictionary with host IDs as keys and lists of tags as values.
+    :return: Dictionary with tags as keys and sets of host IDs as values.
+    """
+    tag_index = dict()
+    for host, tags in db.items():
+        for tag in tags or ():
+            try:
+                tag_index[tag].add(host)
+            except KeyError:
+                tag_index[tag] = {host}
+    return tag_index
+
+
+def match_hosts(db, tag_index, tags):
+    """
+    Find hosts that have all specified tags.
+    :param db: Host database used to build the tag index.
+    :param tag_index: Inverted index returned by build_tag_index().
+    :param tags: Iterable of tags.
+    :return: Set of host IDs. Every host is matched if the tag list is empty.
+    """
+    tags = set(tags)
+    if not tags:
+        return set(db.keys())
+    try:
+        posting_lists = sorted((tag_index[tag] for tag in tags), key=len)
+    except KeyError:
+        return set()  # one of the tags is not assigned to any host
+    hosts = set(posting_lists[0])
+    for posting_list in posting_lists[1:]:
+        if not hosts:
+            break
+        hosts.intersection_update(posting_list)
+    return hosts
+
+
+def scan(db, blocks):
+    # host selection as implemented before the tag index
+    matched = list()
+    for block in blocks:
+        tags = set(block['tags'])
+        hosts = set()
+        for host in db.keys():
+            db_tags = set(db[host])
+            if tags.issubset(db_tags):
+                hosts.add(host)
+        matched.append(hosts)
+    return matched
+
+
+def indexed(db, blocks):
+    tag_index = build_tag_index(db)
+    return [match_hosts(db, tag_index, block['tags']) for block in blocks]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tag index benchmark.')
+    parser.add_argument('--hosts', type=int, default=50000, help='Number of synthetic hosts.')
+    parser.add_argument('--blocks', type=int, default=500, help='Number of task blocks.')
+    args = parser.parse_args()
+
+    db = synthetic_db(args.hosts)
+    blocks = synthetic_blocks(args.blocks, args.hosts)
+
+    start = time.perf_counter()
+    scan_result = scan(db, blocks)
+    scan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index_result = indexed(db, blocks)
+    index_time = time.perf_counter() - start
+
+    if scan_result != index_result:
+        sys.exit('ERROR: Tag index returned different hosts!')
+
+    print('hosts: %d, blocks: %d' % (args.hosts, args.blocks))
+    print('scan:  %.3f s' % scan_time)
+    print('index: %.3f s (including index build)' % index_time)
+    print('speedup: %.1fx' % (scan_time / index_time))
+
+
+if __name__ == '__main__':
+    main()
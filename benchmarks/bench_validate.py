@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# Compare validation of host variables with rendering configs for the whole fleet.
+
+__author__ = 'Petr Ankudinov'
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from benchmarks import synth
+from benchmarks.synth import timed
+from benchmarks.run import BenchEnvironment, REPO_TEMPLATES
+from modules import delivery
+from modules.j2ASTwalker import J2Meta
+from modules.validate import Validator, template_required_paths
+
+# names defined in the template and Jinja2 builtins are not required, hostname and peer_list are
+LOCAL_NAMES_TEMPLATE = '''{% set mtu = 9214 %}{% set ns = namespace(count=0) %}
+hostname {{ hostname }}
+interface Ethernet1
+  mtu {{ mtu }}
+{%- for peer in peer_list %}
+{%- set ns.count = ns.count + 1 %}
+neighbor {{ peer.ip }} description peer{{ loop.index }}
+{%- endfor %}
+{%- for i in range(2) %}
+! {{ i }}
+{%- endfor %}
+'''
+
+
+def check_local_names(work_dir):
+    template = os.path.join(work_dir, 'local_names.j2')
+    with open(template, mode='w') as file:
+        file.write(LOCAL_NAMES_TEMPLATE)
+    paths = template_required_paths(J2Meta(template))
+    if paths != ['hostname', 'peer_list[].ip']:
+        sys.exit('ERROR: Template names or Jinja2 builtins are reported as required: %s' % ', '.join(paths))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Validation benchmark.')
+    parser.add_argument('--hosts', type=int, default=10000, help='Number of hosts.')
+    parser.add_argument('--blocks', type=int, default=300, help='Number of task blocks.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        check_local_names(work_dir)
+        template_dir = os.path.join(work_dir, 'templates')
+        shutil.copytree(REPO_TEMPLATES, template_dir)
+        env = BenchEnvironment(synth.host_db(args.hosts), synth.task(args.blocks), template_dir)
+
+        host_tasks, merge_time = timed(lambda: delivery.build_host_tasks(env))
+        validator = Validator()
+        gaps, validate_time = timed(lambda: [e for e in validator.iter_gaps(host_tasks) if e[1] or e[2]])
+        _, render_time = timed(lambda: list(delivery.iter_configs(env, host_tasks=host_tasks)))
+        _, render_each_time = timed(lambda: list(delivery.iter_configs(env, host_tasks=host_tasks,
+                                                                       render_each=True)))
+
+    print('hosts: %d, host classes: %d, templates: %d, hosts with missing variables: %d' % (
+        len(host_tasks), validator.checks, len(validator.templates), len(gaps)))
+    print('%-36s %8.3f s' % ('build host tasks:', merge_time))
+    print('%-36s %8.3f s' % ('validate:', validate_time))
+    print('%-36s %8.3f s' % ('render per class:', render_time))
+    print('%-36s %8.3f s' % ('render per host:', render_each_time))
+
+
+if __name__ == '__main__':
+    main()
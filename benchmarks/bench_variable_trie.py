@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Compare build_dict_recursive() with the incremental VariableTrie and eager extraction with iter_variables().
+
+__author__ = 'Petr Ankudinov'
+
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from benchmarks import synth
+from benchmarks.synth import timed
+from modules.j2ASTwalker import J2Meta, TemplateASTCache, VariableTrie, iter_paths, value_dict
+from modules.tools import merge_dict, build_dict
+
+
+def build_dict_recursive(lst_or_tpl):
+    # previous implementation of the variable dictionary builder, replaced by VariableTrie.
+    # Recursive function that builds a hierarchical dictionary from lists and sublists of (key_list, value) tuples.
+
+    if isinstance(lst_or_tpl, tuple):
+        if isinstance(lst_or_tpl[1], list):
+            value = list()
+            for e in lst_or_tpl[1]:
+                value.append(build_dict_recursive(e))
+        elif isinstance(lst_or_tpl[1], tuple):
+            value = build_dict_recursive(lst_or_tpl[1])
+        else:
+            value = lst_or_tpl[1]
+        result = build_dict(list(reversed(lst_or_tpl[0])), value)
+    elif isinstance(lst_or_tpl, list):
+        result = dict()
+        for e in lst_or_tpl:
+            result = merge_dict(result, build_dict_recursive(e))
+    else:
+        result = lst_or_tpl
+
+    return result
+
+
+def synthetic_walk(count):
+    # (key list, value) tuples like the AST walk returns them: nested attributes, loops and repeated variables
+    result_list = list()
+    for i in range(count):
+        if i % 10 == 0:
+            result_list.append((['list%d' % (i % 50)],
+                                [[(['item%d' % (i % 30), 'attr%d' % (i % 7)], value_dict['not defined'])],
+                                 value_dict['list']]))
+        else:
+            key_list = ['group%d' % (i % 40)] + ['level%d' % level for level in range(i % 6)] + ['var%d' % (i % 5000)]
+            result_list.append((key_list, value_dict['not defined']))
+    return result_list
+
+
+def copy_walk(result_list):
+    # build_dict_recursive() modifies key lists of nested tuples, every run gets a fresh copy
+    return [(list(key_list), value) for key_list, value in result_list]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Variable trie benchmark.')
+    parser.add_argument('--keys', type=int, default=20000, help='Number of (key list, value) tuples.')
+    parser.add_argument('--include-depth', type=int, default=5, help='Include depth of the template tree.',
+                        dest='include_depth')
+    args = parser.parse_args()
+
+    result_list = synthetic_walk(args.keys)
+    recursive_dict, recursive_time = timed(lambda: build_dict_recursive(copy_walk(result_list)))
+    trie_dict, trie_time = timed(lambda: VariableTrie(copy_walk(result_list)).to_dict())
+    if recursive_dict != trie_dict:
+        sys.exit('ERROR: VariableTrie built a different dictionary!')
+    paths = set(path for key_list, value in result_list for path in iter_paths(key_list, value))
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        root_template = os.path.join(work_dir, synth.template_tree(work_dir, depth=args.include_depth))
+        for template in [root_template] + [os.path.join(os.path.dirname(os.path.dirname(
+                os.path.realpath(__file__))), 'templates', name) for name in ['vlan.j2', 'vxlan.j2']]:
+            template_meta = J2Meta(template, template_ast_cache=TemplateASTCache())
+            result_list = list(template_meta.iter_walk())
+            if build_dict_recursive(copy_walk(result_list)) != template_meta.get_variables():
+                sys.exit('ERROR: VariableTrie result is different for %s!' % template)
+
+        # AST cache is cold for every run, the first path is found in the first walked template
+        _, eager_time = timed(lambda: J2Meta(root_template, template_ast_cache=TemplateASTCache()).get_variables())
+        _, first_time = timed(lambda: next(J2Meta(root_template, template_ast_cache=TemplateASTCache())
+                                           .iter_variables()))
+        _, lookup_time = timed(lambda: J2Meta(root_template, template_ast_cache=TemplateASTCache())
+                               .has_variable('vxlan.loopback.ip'))
+
+    print('tuples: %d, unique paths: %d' % (args.keys, len(paths)))
+    print('%-36s %10.3f ms' % ('build_dict_recursive:', recursive_time * 1000))
+    print('%-36s %10.3f ms' % ('VariableTrie:', trie_time * 1000))
+    print('%-36s %10.3f ms' % ('get_variables, template tree:', eager_time * 1000))
+    print('%-36s %10.3f ms' % ('first path from iter_variables:', first_time * 1000))
+    print('%-36s %10.3f ms' % ('has_variable with early stop:', lookup_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
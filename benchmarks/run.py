@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# Benchmark suite for extraction, variable merging and fleet rendering.
+# Every stage is timed on synthetic inputs, peak memory is measured in a separate run with tracemalloc.
+# Results are compared with a stored baseline, so regressions show up as numbers.
+
+__author__ = 'Petr Ankudinov'
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import yaml
+from benchmarks import synth, bench_startup
+from benchmarks.bench_variable_trie import build_dict_recursive
+from modules import tools, delivery
+from modules.hostdb import HostDB
+from modules.j2ASTwalker import J2Meta, TemplateASTCache, VariableTrie
+
+BASELINE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+REPO_TEMPLATES = os.path.join(os.path.dirname(BENCHMARK_DIR), 'templates')
+
+
+class BenchEnvironment:
+    # minimal replacement of ScriptEnvironment for delivery functions
+
+    def __init__(self, json_db, json_data, template_path):
+        self.json_db = HostDB(json_db)
+        self.json_data = json_data
+        self.template_path = template_path
+        self.template_cache_size = 256
+        self.bytecode_cache = False
+
+
+def stage_load_yaml(work_dir, size, args):
+    db_file = os.path.join(work_dir, 'db_%d.yaml' % size)
+    if not os.path.isfile(db_file):
+        with open(db_file, mode='w') as file:
+            for host, tags in synth.host_db(size).items():
+                file.write('%s: [%s]\n' % (host, ', '.join(tags)))
+
+    def run():
+        if not isinstance(tools.load_yaml(db_file), dict):
+            raise Exception('Can not load %s' % db_file)
+    return run
+
+
+def template_tree(work_dir, args):
+    template_dir = os.path.join(work_dir, 'tree')
+    if not os.path.isdir(template_dir):
+        os.makedirs(template_dir)
+        synth.template_tree(template_dir, depth=args.include_depth)
+    return os.path.join(template_dir, 'level0_0.j2')
+
+
+def stage_extract(work_dir, size, args):
+    # AST cache is cold for every extraction
+    root_template = template_tree(work_dir, args)
+
+    def run():
+        for _ in range(args.extractions):
+            J2Meta(root_template, template_ast_cache=TemplateASTCache()).get_variables()
+    return run
+
+
+def stage_merge_dict(work_dir, size, args):
+    # merge all variable blocks of the task for a single host
+    blocks = [block['variables'] for block in synth.task(args.blocks, vlans=args.vlans) if 'variables' in block]
+
+    def run():
+        merged = dict()
+        for block in blocks:
+            merged = tools.merge_dict(merged, block)
+    return run
+
+
+def stage_build_dict(work_dir, size, args):
+    key_lists = [['level%d' % level for level in range(i % 20)] + ['key%d' % i] for i in range(args.keys)]
+
+    def run():
+        merged = dict()
+        owned = dict()
+        for key_list in key_lists:
+            merged = tools.merge_dict(merged, tools.build_dict(list(reversed(key_list)), 'value'), in_place=True,
+                                      owned=owned)
+    return run
+
+
+def walk_results(work_dir, args):
+    # (key list, value) tuples of the template tree, repeated up to the number of keys
+    result_list = list(J2Meta(template_tree(work_dir, args)).iter_walk())
+    return (result_list * (args.keys // len(result_list) + 1))[:args.keys]
+
+
+def stage_build_dict_recursive(work_dir, size, args):
+    result_list = walk_results(work_dir, args)
+
+    def run():
+        build_dict_recursive([(list(key_list), value) for key_list, value in result_list])
+    return run
+
+
+def stage_variable_trie(work_dir, size, args):
+    result_list = walk_results(work_dir, args)
+
+    def run():
+        VariableTrie([(list(key_list), value) for key_list, value in result_list]).to_dict()
+    return run
+
+
+def stage_build_configs(work_dir, size, args):
+    template_dir = os.path.join(work_dir, 'fleet')
+    if not os.path.isdir(template_dir):
+        shutil.copytree(REPO_TEMPLATES, template_dir)
+    json_db = synth.host_db(size)
+    json_data = synth.task(args.blocks)
+
+    def run():
+        delivery.build_configs(BenchEnvironment(json_db, json_data, template_dir), jobs=args.jobs)
+    return run
+
+
+def startup(mode):
+    # complete j2p.py run in a new interpreter, the host db of the repo is extended to the stage size
+    def stage_startup(work_dir, size, args):
+        repo_dir = os.path.join(work_dir, 'startup_%d' % size, 'repo')
+        if not os.path.isdir(repo_dir):
+            bench_startup.copy_repo(os.path.dirname(repo_dir), size)
+
+        def run():
+            bench_startup.run_cli(repo_dir, bench_startup.MODES[mode])
+        return run
+    return stage_startup
+
+
+STAGES = [
+    # stage name, stage function, True if the stage runs for every host db size
+    ('load_yaml', stage_load_yaml, True),
+    ('get_variables', stage_extract, False),
+    ('merge_dict', stage_merge_dict, False),
+    ('build_dict', stage_build_dict, False),
+    ('build_dict_recursive', stage_build_dict_recursive, False),
+    ('variable_trie', stage_variable_trie, False),
+    ('build_configs', stage_build_configs, True),
+    ('startup_j2', startup('j2'), True),
+    ('startup_save', startup('save'), True),
+]
+
+
+def measure(run, memory, repeat):
+    # best time of several runs, peak memory of a single run
+    elapsed = False
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        elapsed = min(elapsed or float('inf'), time.perf_counter() - start)
+    peak = False
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='J2parser benchmark suite.')
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='Comma separated host db sizes, e.g. 1000,10000,100000.')
+    parser.add_argument('--stages', default=','.join(stage[0] for stage in STAGES),
+                        help='Comma separated stages to run.')
+    parser.add_argument('--blocks', type=int, default=300, help='Number of tag blocks in the task.')
+    parser.add_argument('--vlans', type=int, default=200, help='Number of VLANs in every merged variable block.')
+    parser.add_argument('--keys', type=int, default=20000, help='Number of variables for dictionary builders.')
+    parser.add_argument('--include-depth', type=int, default=5, help='Include depth of the template tree.',
+                        dest='include_depth')
+    parser.add_argument('--extractions', type=int, default=50, help='Number of variable extractions.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes for build_configs.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs, the best time is reported.')
+    parser.add_argument('--no-memory', help='Do not measure peak memory.', dest='memory', action='store_false')
+    parser.add_argument('--baseline', default=BASELINE, help='Baseline JSON file.')
+    parser.add_argument('--save-baseline', help='Save results as the new baseline.', dest='save_baseline',
+                        action='store_true')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='Report a regression if time or memory grows more than this ratio.')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    stages = [stage for stage in STAGES if stage[0] in args.stages.split(',')]
+
+    try:
+        with open(args.baseline, mode='r') as file:
+            baseline = json.load(file)['results']
+    except Exception as _:
+        baseline = dict()
+
+    results = dict()
+    regressions = list()
+    print('%-22s %8s %10s %12s %10s %7s %7s' % ('stage', 'size', 'time, s', 'peak, KiB', 'baseline', 'time', 'memory'))
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name, stage, sized in stages:
+            for size in (sizes if sized else [0]):
+                key = '%s/%d' % (name, size) if sized else name
+                try:
+                    elapsed, peak = measure(stage(work_dir, size, args), args.memory, args.repeat)
+                except Exception as e:
+                    print('%-22s %8s FAILED: %s' % (name, size or '-', e))
+                    continue
+                results[key] = {'time': round(elapsed, 4), 'peak': peak}
+                line = '%-22s %8s %10.3f %12s' % (name, size or '-', elapsed, peak // 1024 if peak else '-')
+                try:
+                    reference = baseline[key]
+                except KeyError:
+                    print(line)
+                    continue
+                time_ratio = elapsed / reference['time'] if reference['time'] else 1
+                line += ' %10.3f %6.2fx' % (reference['time'], time_ratio)
+                if time_ratio > args.threshold:
+                    regressions.append('%s time %.2fx' % (key, time_ratio))
+                if peak and reference['peak']:
+                    memory_ratio = peak / reference['peak']
+                    line += ' %6.2fx' % memory_ratio
+                    if memory_ratio > args.threshold:
+                        regressions.append('%s memory %.2fx' % (key, memory_ratio))
+                print(line)
+
+    if args.save_baseline:
+        with open(args.baseline, mode='w') as file:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'yaml_libyaml': yaml.__with_libyaml__,
+                'results': dict(baseline, **results),  # stages that were not run keep previous values
+            }, file, indent=1, sort_keys=True)
+        print('Baseline saved to %s' % args.baseline)
+
+    if regressions:
+        for regression in regressions:
+            print('REGRESSION: %s' % regression)
+        if not args.save_baseline:
+            sys.exit('ERROR: %d regression(s) above %.2fx!' % (len(regressions), args.threshold))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# Synthetic inputs for benchmarks: host databases, task files and template trees. Shared timing helper.
+
+__author__ = 'Petr Ankudinov'
+
+import os
+import random
+import time
+
+SITES = 20
+PODS = 200
+
+
+def timed(function):
+    # result of function() and wall time in seconds
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def host_db(host_count, seed=0):
+    """
+    Build a host database in db.yaml format.
+    :param host_count: Number of hosts.
+    :param seed: Random seed.
+    :return: Dictionary with host IDs as keys and lists of tags as values.
+    """
+    rnd = random.Random(seed)
+    db = dict()
+    for i in range(host_count):
+        host = 'leaf%d' % i
+        db[host] = [host, 'site%d' % rnd.randrange(SITES), 'pod%d' % rnd.randrange(PODS),
+                    'mlag%d' % (i // 2), rnd.choice(['switch', 'router']), 'any']
+    return db
+
+
+def variables(block_number, vlans):
+    return {
+        'vlan_list': [{'name': 'vlan_%d' % vlan, 'number': vlan, 'vni': '0.0.%d' % vlan}
+                      for vlan in range(block_number, block_number + vlans)],
+        'vxlan': {
+            'loopback': {
+                'description': 'vxlan_source',
+                'ip': '10.%d.%d.1' % (block_number // 250 % 250, block_number % 250),
+                'mask': 32,
+                'number': 100,
+            },
+            'required': True,
+            'vtep_list': ['10.0.%d.1' % (block_number % 250), '10.1.%d.1' % (block_number % 250)],
+        },
+        'block%d' % block_number: {'enabled': True},
+    }
+
+
+def task(block_count, vlans=10, templates=('vlan.j2',), seed=0):
+    """
+    Build a task in the task file format.
+    Variable blocks are assigned to sites, pods and roles, every host gets templates through the 'any' tag.
+    :param block_count: Number of variable blocks.
+    :param vlans: Number of VLANs defined by every variable block.
+    :param templates: Template names rendered for every host.
+    :param seed: Random seed.
+    :return: List of task blocks.
+    """
+    rnd = random.Random(seed)
+    json_data = [{'tags': ['any'], 'variables': variables(0, vlans)}]
+    for i in range(1, block_count):
+        kind = rnd.randrange(3)
+        if kind == 0:
+            tags = ['site%d' % rnd.randrange(SITES)]
+        elif kind == 1:
+            tags = ['pod%d' % rnd.randrange(PODS), 'switch']
+        else:
+            tags = [rnd.choice(['switch', 'router']), 'any']
+        json_data.append({'tags': tags, 'variables': variables(i, vlans)})
+    json_data.append({'tags': ['any'], 'templates': list(templates)})
+    return json_data
+
+
+def template_tree(directory, depth=5, width=3):
+    """
+    Write a template tree: every template includes the next level templates and loops over VLANs.
+    Templates on the deepest level are included by many parents.
+    :param directory: Directory for template files.
+    :param depth: Include depth.
+    :param width: Number of templates included by every template.
+    :return: Root template filename.
+    """
+    for level in range(depth, -1, -1):
+        for index in range(width if level else 1):
+            lines = [
+                '{%- for vlan in vlan_list %}',
+                'vlan {{ vlan.number }}',
+                '  name {{ vlan.name }}_%d_%d' % (level, index),
+                '{%- endfor %}',
+                '{% if vxlan.required == True %}',
+                'interface Loopback{{ vxlan.loopback.number }}',
+                '  ip address {{ vxlan.loopback.ip }}/{{ vxlan.loopback.mask }}',
+                '{%- for vtep in vxlan.vtep_list %}',
+                '  vxlan flood vtep {{ vtep }}',
+                '{%- endfor %}',
+                '{% endif %}',
+            ]
+            if level < depth:
+                lines.extend("{%% include 'level%d_%d.j2' %%}" % (level + 1, child) for child in range(width))
+            with open(os.path.join(directory, 'level%d_%d.j2' % (level, index)), mode='w') as file:
+                file.write('\n'.join(lines))
+    return 'level0_0.j2'
@@ -2,8 +2,9 @@
 
 __author__ = 'Petr Ankudinov'
 
-from modules.j2ASTwalker import J2Meta
-from modules import tools, delivery
+# modules required by a single mode are imported by that mode, see main()
+from modules import tools
+from modules.profiler import run_profiled
 import sys
 import yaml
 import os
@@ -19,14 +20,77 @@ class ArgParser:
         parser.add_argument('file_type', help='Jinja2 or YAML file.',
                             choices=['j2', 'yaml'])
 
-        subparsers = parser.add_subparsers(help='Select delivery mode, YAML only.', dest='mode')
+        parser.add_argument('--profile', help='Print time, calls and bytes for every stage and template.',
+                            dest='profile', action='store_true')
+        parser.add_argument('--profile-output', help='Save profile as JSON, or as cProfile stats if name ends with .prof',
+                            dest='profile_output', default=False)
+
+        subparsers = parser.add_subparsers(help='Select delivery mode for YAML or batch mode for Jinja2.', dest='mode')
         save_parser = subparsers.add_parser('save', help='Save generated configs in a directory specified in settings.')
         save_parser.add_argument('-p', '--prefix', help='Config filename prefix.', dest='prefix', default=False)
+        save_parser.add_argument('-s', '--stats', help='Print template cache statistics.', dest='stats',
+                                 action='store_true')
+        save_parser.add_argument('-j', '--jobs', help='Number of processes to render configs.', dest='jobs',
+                                 type=int, default=1)
+        save_parser.add_argument('--stream', help='Write rendered templates to files chunk by chunk.',
+                                 dest='stream', action='store_true')
+        save_parser.add_argument('-f', '--force', help='Write configs even if the latest saved config is the same.',
+                                 dest='force', action='store_true')
+        save_parser.add_argument('-b', '--bundle', help='Save all configs of the run as a single file.',
+                                 dest='bundle', choices=['jsonl', 'tar'], default=False)
+        save_parser.add_argument('--render-each', help='Render every host, even if other hosts of the same class '
+                                                       'share all task blocks (templates with random filters).',
+                                 dest='render_each', action='store_true')
+        save_parser.add_argument('-i', '--incremental', help='Render only hosts with changed templates or variables.',
+                                 dest='incremental', action='store_true')
+        push_parser = subparsers.add_parser('push', help='Push generated configs to devices.')
+        push_parser.add_argument('-t', '--transport', help='Transport, overrides delivery settings.',
+                                 dest='transport', choices=['eapi', 'ssh'], default=False)
+        push_parser.add_argument('-c', '--concurrency', help='Number of hosts to push at the same time.',
+                                 dest='concurrency', type=int, default=False)
+        push_parser.add_argument('-j', '--jobs', help='Number of processes to render configs.', dest='jobs',
+                                 type=int, default=1)
+        push_parser.add_argument('-r', '--report', help='Save per host results and timings as JSON.',
+                                 dest='report', default=False)
+        push_parser.add_argument('--render-each', help='Render every host, even if other hosts of the same class '
+                                                       'share all task blocks (templates with random filters).',
+                                 dest='render_each', action='store_true')
+        validate_parser = subparsers.add_parser('validate', help='Find hosts with variables missing for their '
+                                                                 'templates without rendering configs.')
+        validate_parser.add_argument('-r', '--report', help='Save missing variables of every host as JSON.',
+                                     dest='report', default=False)
+        index_parser = subparsers.add_parser('index', help='Update the dependency index and find hosts affected by '
+                                                           'template or variable changes.')
+        index_parser.add_argument('-t', '--template', help='Template filename, can be used many times.',
+                                  dest='index_templates', action='append', default=list())
+        index_parser.add_argument('-v', '--variable', help='Dotted variable path, e.g. vxlan.loopback.mask. '
+                                                           'Can be used many times.',
+                                  dest='index_variables', action='append', default=list())
+        serve_parser = subparsers.add_parser('serve', help='Keep host db, task and templates loaded and render '
+                                                           'configs on request over HTTP or a Unix socket.')
+        serve_parser.add_argument('-b', '--bind', help='Address and port to listen on.', dest='bind',
+                                  default='127.0.0.1:8080')
+        serve_parser.add_argument('-u', '--unix-socket', help='Listen on a Unix socket instead of TCP.',
+                                  dest='unix_socket', default=False)
+        serve_parser.add_argument('--check-interval', help='Seconds between checks for changed files.',
+                                  dest='check_interval', type=float, default=0)
+        serve_parser.add_argument('-v', '--verbose', help='Log every request.', dest='verbose', action='store_true')
+        batch_parser = subparsers.add_parser('batch', help='Extract variables from a directory or a glob of templates.')
+        batch_parser.add_argument('-j', '--jobs', help='Number of processes to extract variables.', dest='jobs',
+                                  type=int, default=1)
+        batch_parser.add_argument('-f', '--format', help='Output format.', dest='format', choices=['yaml', 'json'],
+                                  default='yaml')
+        batch_parser.add_argument('-m', '--merge', help='Merge variables from all templates into a single document.',
+                                  dest='merge', action='store_true')
 
         if args:  # if arguments are passed from unittest
             self.args = parser.parse_args(args)
         else:
             self.args = parser.parse_args()
+        if self.args.mode == 'save' and self.args.stream and self.args.jobs > 1:
+            parser.error('--stream can not be combined with --jobs.')
+        if self.args.mode == 'save' and self.args.stream and self.args.bundle:
+            parser.error('--stream can not be combined with --bundle.')
 
     def prefix(self):
         if self.args.mode == 'save':
@@ -34,6 +98,120 @@ class ArgParser:
         else:
             return False
 
+    def cache_stats(self):
+        if self.args.mode == 'save':
+            return self.args.stats
+        else:
+            return False
+
+    def jobs(self):
+        if self.args.mode in ['save', 'push', 'batch']:
+            return max(1, self.args.jobs)
+        else:
+            return 1
+
+    def stream(self):
+        if self.args.mode == 'save':
+            return self.args.stream
+        else:
+            return False
+
+    def force(self):
+        if self.args.mode == 'save':
+            return self.args.force
+        else:
+            return False
+
+    def bundle(self):
+        if self.args.mode == 'save':
+            return self.args.bundle
+        else:
+            return False
+
+    def render_each(self):
+        if self.args.mode in ['save', 'push']:
+            return self.args.render_each
+        else:
+            return False
+
+    def incremental(self):
+        if self.args.mode == 'save':
+            return self.args.incremental
+        else:
+            return False
+
+    def transport(self):
+        if self.args.mode == 'push':
+            return self.args.transport
+        else:
+            return False
+
+    def concurrency(self):
+        if self.args.mode == 'push':
+            return self.args.concurrency
+        else:
+            return False
+
+    def report(self):
+        if self.args.mode in ['push', 'validate']:
+            return self.args.report
+        else:
+            return False
+
+    def index_templates(self):
+        if self.args.mode == 'index':
+            return self.args.index_templates
+        else:
+            return list()
+
+    def index_variables(self):
+        if self.args.mode == 'index':
+            return self.args.index_variables
+        else:
+            return list()
+
+    def bind(self):
+        if self.args.mode == 'serve':
+            return self.args.bind
+        else:
+            return False
+
+    def unix_socket(self):
+        if self.args.mode == 'serve':
+            return self.args.unix_socket
+        else:
+            return False
+
+    def check_interval(self):
+        if self.args.mode == 'serve':
+            return max(0, self.args.check_interval)
+        else:
+            return 0
+
+    def verbose(self):
+        if self.args.mode == 'serve':
+            return self.args.verbose
+        else:
+            return False
+
+    def output_format(self):
+        if self.args.mode == 'batch':
+            return self.args.format
+        else:
+            return 'yaml'
+
+    def merge(self):
+        if self.args.mode == 'batch':
+            return self.args.merge
+        else:
+            return False
+
+    def profile(self):
+        return self.args.profile or bool(self.args.profile_output)
+
+    def profile_output(self):
+        return self.args.profile_output
+
     def mode(self):
         return self.args.mode
 
@@ -55,20 +233,62 @@ class ScriptEnvironment:
             self.template_path = self.get_dir(settings['template_path'])
             self.configs_path = self.get_dir(settings['configs'])
             self.task_path = self.get_dir(settings['task_path'])
-            db_name = self.get_file(self.script_realpath, settings['host_db'])
-            self.json_db = tools.load_yaml(db_name)
-            if not isinstance(self.json_db, dict):
-                sys.exit('ERROR: Wrong db format. Database file should be a dictionary!')
+            # optional template cache parameters
+            self.template_cache_size = settings.get('template_cache_size', 256)
+            self.bytecode_cache = settings.get('bytecode_cache', False)
+            # optional directory to keep parsed host db and task files
+            self.yaml_cache = settings.get('yaml_cache', False)
+            # optional push engine parameters
+            self.delivery = dict(settings.get('delivery') or dict())
             # get parameters from CLI
             self.file_type = cli_args.file_type()
             if self.file_type == "yaml":
+                # host db is required to build configs only
+                from modules.hostdb import HostDB
+                self.db_name = self.get_file(self.script_realpath, settings['host_db'])
+                json_db = tools.load_yaml(self.db_name, cache_dir=self.yaml_cache)
+                if not isinstance(json_db, dict):
+                    sys.exit('ERROR: Wrong db format. Database file should be a dictionary!')
+                self.json_db = HostDB(json_db)
                 self.filename = self.get_file(self.task_path, cli_args.filename())
-                self.json_data = tools.load_yaml(self.filename)
+                self.json_data = tools.load_yaml(self.filename, cache_dir=self.yaml_cache)
                 self.mode = cli_args.mode()
                 if self.mode == 'save':
                     self.prefix = cli_args.prefix()
+                    self.cache_stats = cli_args.cache_stats()
+                    self.jobs = cli_args.jobs()
+                    self.stream = cli_args.stream()
+                    self.incremental = cli_args.incremental()
+                    self.force = cli_args.force()
+                    self.bundle = cli_args.bundle()
+                    self.render_each = cli_args.render_each()
+                elif self.mode == 'push':
+                    self.jobs = cli_args.jobs()
+                    self.report = cli_args.report()
+                    self.render_each = cli_args.render_each()
+                    if cli_args.transport():
+                        self.delivery['transport'] = cli_args.transport()
+                    if cli_args.concurrency():
+                        self.delivery['concurrency'] = cli_args.concurrency()
+                elif self.mode == 'validate':
+                    self.report = cli_args.report()
+                elif self.mode == 'index':
+                    self.index_templates = cli_args.index_templates()
+                    self.index_variables = cli_args.index_variables()
+                elif self.mode == 'serve':
+                    self.bind = cli_args.bind()
+                    self.unix_socket = cli_args.unix_socket()
+                    self.check_interval = cli_args.check_interval()
+                    self.verbose = cli_args.verbose()
             else:
-                self.filename = self.get_file(self.template_path, cli_args.filename())
+                self.mode = cli_args.mode()
+                if self.mode == 'batch':
+                    self.template_list = self.get_template_list(cli_args.filename())
+                    self.jobs = cli_args.jobs()
+                    self.output_format = cli_args.output_format()
+                    self.merge = cli_args.merge()
+                else:
+                    self.filename = self.get_file(self.template_path, cli_args.filename())
         except Exception as _:
             sys.exit('ERROR: Can not load settings!')
 
@@ -92,20 +312,78 @@ class ScriptEnvironment:
             else:
                 sys.exit('ERROR: Can not find file %s!' % file_name)
 
+    def get_template_list(self, pattern):
+        # templates from a directory (*.j2 files, recursive) or a glob pattern
+        import glob
+        for path in [pattern, os.path.join(self.template_path, pattern)]:
+            if os.path.isdir(path):
+                template_list = glob.glob(os.path.join(path, '**', '*.j2'), recursive=True)
+            else:
+                template_list = [file for file in glob.glob(path, recursive=True) if os.path.isfile(file)]
+            if template_list:
+                return sorted(template_list)
+        sys.exit('ERROR: Can not find templates %s!' % pattern)
+
 
-if __name__ == '__main__':
+def main(cli_args):
     # define script environment
-    cli_args = ArgParser()
     env = ScriptEnvironment(cli_args)
 
     # delivery.run(env)
 
     if env.file_type == 'j2':
-        template_meta = J2Meta(env.filename)
-        print(
-            yaml.dump(template_meta.get_variables(), default_flow_style=False)
-        )
+        if env.mode == 'batch':
+            from modules.j2ASTwalker import iter_variables_batch
+            import json
+            merged_variables = dict()
+            owned = dict()  # dictionaries created by merge_dict(), modified in place
+            failed = 0
+            for template, variables, error in iter_variables_batch(env.template_list, jobs=env.jobs):
+                if error:
+                    failed += 1
+                    print('ERROR: %s: %s' % (template, error), file=sys.stderr)
+                elif env.merge:
+                    merged_variables = tools.merge_dict(merged_variables, variables, in_place=True, owned=owned)
+                elif env.output_format == 'json':
+                    print(json.dumps({template: variables}, sort_keys=True, default=str))  # one JSON per line
+                else:
+                    print('---')
+                    print(yaml.dump({template: variables}, default_flow_style=False))
+            if env.merge:
+                if env.output_format == 'json':
+                    print(json.dumps(merged_variables, sort_keys=True, default=str, indent=2))
+                else:
+                    print(yaml.dump(merged_variables, default_flow_style=False))
+            if failed:
+                sys.exit('ERROR: Not able to extract variables from %d template(s)!' % failed)
+        else:
+            from modules.j2ASTwalker import J2Meta
+            template_meta = J2Meta(env.filename)
+            print(
+                yaml.dump(template_meta.get_variables(), default_flow_style=False)
+            )
 
     if env.file_type == 'yaml':
         if env.mode == 'save':
+            from modules import delivery
             delivery.save_configs(env)
+        if env.mode == 'push':
+            from modules import delivery
+            delivery.push_configs(env)
+        if env.mode == 'validate':
+            from modules.validate import validate_task  # variable extraction is required in validate mode only
+            validate_task(env)
+        if env.mode == 'index':
+            from modules.depindex import query_index  # dependency index is required in index mode only
+            query_index(env)
+        if env.mode == 'serve':
+            from modules.server import serve  # HTTP server is required in serve mode only
+            serve(env)
+
+
+if __name__ == '__main__':
+    cli_args = ArgParser()
+    if cli_args.profile():
+        run_profiled(lambda: main(cli_args), cli_args.profile_output())
+    else:
+        main(cli_args)
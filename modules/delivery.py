@@ -1,90 +1,446 @@
 __author__ = 'Petr Ankudinov'
 
 from modules import tools
+from modules.j2cache import TemplateCache
+from modules.output import ConfigWriter, BundleWriter
+from modules.profiler import profiler
+from time import perf_counter
+import json
 import os
 import sys
-import jinja2
 
 
-def build_configs(env):
-    db = env.json_db
-    json_data = env.json_data
-    variables = dict()
-    configs = dict()
-    for block in json_data:
-        if 'variables' in block.keys():
-            tags = set(block['tags'])
-            for host in db.keys():
-                db_tags = set(db[host])
-                if tags.issubset(db_tags):
-                    try:
-                        variables[host]
-                    except:
-                        variables[host] = block['variables']
-                    else:
-                        variables[host] = tools.merge_dict(variables[host], block['variables'])
+def template_location(template_path, j2):
+    # returns template search path and template filename
+    if os.path.isfile(j2):
+        return os.path.dirname(j2), os.path.basename(j2)
+    else:
+        filename = os.path.join(template_path, j2)
+        return os.path.dirname(filename), os.path.basename(filename)
+
 
+def get_template_cache(env):
+    # template cache is created once and reused for the whole run
+    try:
+        return env.template_cache
+    except AttributeError:
+        env.template_cache = TemplateCache(max_size=env.template_cache_size, bytecode_dir=env.bytecode_cache)
+        return env.template_cache
+
+
+def build_class_task(json_data, locations, signature):
+    """
+    Merge variables and collect templates for a class of hosts matched by the same task blocks.
+    :param json_data: Task blocks.
+    :param locations: Template locations of every task block.
+    :param signature: Numbers of task blocks matching the hosts of the class.
+    :return: List of (template search path, template filename, variables) tuples.
+    """
+    variables = None
+    owned = None  # dictionaries created by merges, not shared with task blocks or captured by templates
+    host_task = list()
+    for number in signature:
+        block = json_data[number]
+        if 'variables' in block.keys():
+            if variables is None:
+                variables = block['variables']
+            elif owned is not None:
+                tools.merge_dict(variables, block['variables'], in_place=True, owned=owned)
+            else:
+                owned = dict()
+                variables = tools.merge_dict(variables, block['variables'], owned=owned)
         if 'templates' in block.keys():
-            tags = set(block['tags'])
-            for host in db.keys():
-                db_tags = set(db[host])
-                if tags.issubset(db_tags):
+            for template_search_path, template_filename in locations[number]:
+                host_task.append((template_search_path, template_filename, variables))
+            owned = None
+    return host_task
+
 
+def host_classes(env):
+    """
+    Select hosts for every task block. Hosts matched by the same task blocks form a class.
+    :param env: Script environment.
+    :return: Dictionary with tuples of task block numbers as keys and lists of host IDs as values.
+    """
+    json_data = env.json_data
+    with profiler.stage('match_tags'):
+        signatures = dict()  # host: numbers of task blocks matching the host
+        matched_hosts = env.json_db.match_all(block['tags'] for block in json_data)  # same tags are matched once
+        for number, hosts in enumerate(matched_hosts):
+            if 'variables' in json_data[number].keys() or 'templates' in json_data[number].keys():
+                for host in hosts:
                     try:
-                        configs[host]
-                    except:
-                        configs[host] = dict()
-                        configs[host]['configuration'] = ''
-                        configs[host]['mode'] = False
-                        configs[host]['login'] = False
-                        configs[host]['password'] = False
-
-                    for j2 in block['templates']:
-                        if os.path.isfile(j2):
-                            template_search_path = os.path.dirname(j2)
-                            template_filename = os.path.basename(j2)
-                        else:
-                            filename = os.path.join(env.template_path, j2)
-                            template_search_path = os.path.dirname(filename)
-                            template_filename = os.path.basename(filename)
-
-                        j2_env = jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath=template_search_path))
-                        j2_template = j2_env.get_template(template_filename)
-
-                        try:
-                            config = j2_template.render(variables[host])
-                            configs[host]['configuration'] = configs[host]['configuration'] + '\n' + config
-
-                        except Exception as _:
-                            try:
-                                config = j2_template.render()
-                                configs[host]['configuration'] = configs[host]['configuration'] + '\n' + config
-                            except Exception as _:
-                                sys.exit('ERROR: Not able to parse template ' + template_filename + '!')
-    return configs
+                        signatures[host].append(number)
+                    except KeyError:
+                        signatures[host] = [number]
+        classes = dict()  # block numbers: hosts
+        for host, signature in signatures.items():
+            try:
+                classes[tuple(signature)].append(host)
+            except KeyError:
+                classes[tuple(signature)] = [host]
+    return classes
 
 
-def save_configs(env):
-    configs = build_configs(env)
-    for ip in configs.keys():
-        filename = ''
-        if env.prefix:
-            filename += env.prefix + '_'
-        filename += str(ip) + '_' + str(tools.time_stamp()) + '.txt'
-        realpath = os.path.join(env.configs_path, filename)
+def build_host_tasks(env):
+    """
+    Select hosts for every task block and merge host variables.
+    Hosts matched by the same task blocks form a class, variables are merged once per class and all hosts
+    of the class share the same task list.
+    :param env: Script environment.
+    :return: Dictionary with host IDs as keys and lists of (template search path, template filename, variables)
+    tuples as values. Variables are captured when the template block is reached, like in serial rendering.
+    """
+    json_data = env.json_data
+    classes = host_classes(env)
+    locations = [[template_location(env.template_path, j2) for j2 in block['templates']]
+                 if 'templates' in block.keys() else None for block in json_data]
+    host_tasks = dict()
+    with profiler.stage('merge_variables'):
+        for signature, hosts in classes.items():
+            host_task = build_class_task(json_data, locations, signature)
+            if host_task:  # hosts matched by variable blocks only have nothing to render
+                for host in hosts:
+                    host_tasks[host] = host_task
+    return host_tasks
+
+
+def render_host(template_cache, host_task):
+    # rendered templates are collected as fragments and joined once
+    fragments = list()
+    for template_search_path, template_filename, host_variables in host_task:
+        j2_template = template_cache.get_template(template_search_path, template_filename)
+        if profiler.active:
+            start = perf_counter()
         try:
-            file = open(realpath, mode='w')
+            if host_variables is None:
+                raise KeyError('No variables assigned.')
+            config = j2_template.render(host_variables)
         except Exception as _:
-            print('ERROR: Can not create ', realpath)
-            sys.exit('ERROR: Can not create ' + realpath)
-        else:
-            file.write(configs[ip]['configuration'])
+            try:
+                config = j2_template.render()
+            except Exception as _:
+                raise Exception('Not able to parse template ' + template_filename + '!')
+        if profiler.active:
+            elapsed = perf_counter() - start
+            profiler.add('render', elapsed, len(config))
+            profiler.add_template(template_filename, elapsed, len(config))
+        fragments.append('\n')
+        fragments.append(config)
+    return ''.join(fragments)
+
+
+def write_host(template_cache, host_task, file):
+    """
+    Render host config straight into a file with Template.generate, without building the config string.
+    :param template_cache: Template cache.
+    :param host_task: List of (template search path, template filename, variables) tuples.
+    :param file: File object opened for writing. Should be seekable to roll back a failed template.
+    :return: None
+    """
+    for template_search_path, template_filename, host_variables in host_task:
+        j2_template = template_cache.get_template(template_search_path, template_filename)
+        file.write('\n')
+        position = file.tell()
+        if profiler.active:
+            start = perf_counter()
+        try:
+            if host_variables is None:
+                raise KeyError('No variables assigned.')
+            for chunk in j2_template.generate(host_variables):
+                file.write(chunk)
+        except Exception as _:
+            # drop partial output and render without variables, like render_host() does
+            file.seek(position)
+            file.truncate()
+            try:
+                for chunk in j2_template.generate():
+                    file.write(chunk)
+            except Exception as _:
+                raise Exception('Not able to parse template ' + template_filename + '!')
+        if profiler.active:
+            elapsed = perf_counter() - start
+            size = file.tell() - position
+            profiler.add('render', elapsed, size)
+            profiler.add_template(template_filename, elapsed, size)
+
+
+def render_chunk(template_cache, chunk):
+    # render a list of (host, host_task) tuples, failures are returned instead of being raised
+    result_list = list()
+    for host, host_task in chunk:
+        try:
+            result_list.append((host, render_host(template_cache, host_task), False))
+        except Exception as e:
+            result_list.append((host, False, str(e) or e.__class__.__name__))
+    return result_list
+
+
+_worker_template_cache = None  # template cache of a process pool worker
+
+
+def _init_worker(max_size, bytecode_dir, profile):
+    global _worker_template_cache
+    _worker_template_cache = TemplateCache(max_size=max_size, bytecode_dir=bytecode_dir)
+    if profile:
+        profiler.pop_stats()  # drop counters inherited from the main process
+        profiler.start()
+
+
+def _render_chunk_in_worker(chunk):
+    hits, misses = _worker_template_cache.hits, _worker_template_cache.misses
+    result_list = render_chunk(_worker_template_cache, chunk)
+    profile_stats = profiler.pop_stats() if profiler.active else False
+    cache_size = (os.getpid(), len(_worker_template_cache.templates), len(_worker_template_cache.environments))
+    return result_list, _worker_template_cache.hits - hits, _worker_template_cache.misses - misses, cache_size, \
+        profile_stats
+
+
+def _chunk_result(future, template_cache):
+    # wait for the worker and add worker cache and profiler counters to the main process counters
+    chunk_result, hits, misses, cache_size, profile_stats = future.result()
+    template_cache.hits += hits
+    template_cache.misses += misses
+    template_cache.workers[cache_size[0]] = cache_size[1:]  # the latest size of every worker cache
+    if profile_stats:
+        profiler.merge_stats(profile_stats)
+    return chunk_result
+
+
+def split_chunks(items, jobs, max_chunk_size=64):
+    # chunks are small enough to keep the number of rendered configs in flight bounded
+    chunk_size = max(1, min(len(items) // (jobs * 4), max_chunk_size))
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+
+def split_classes(host_tasks, render_each=False):
+    """
+    Select one host of every host class to render.
+    Templates get host variables only, so hosts sharing the same task list get the same config.
+    :param host_tasks: Dictionary returned by build_host_tasks().
+    :param render_each: Render every host, e.g. for templates with the random filter.
+    :return: Tuple with a list of (host, host task) tuples to render and a dictionary with rendered hosts as keys and
+    lists of all hosts of the class as values.
+    """
+    render_list = list()
+    members = dict()
+    first_hosts = dict()  # id of the shared task list: first host
+    for host, host_task in host_tasks.items():
+        key = host if render_each else id(host_task)
+        try:
+            members[first_hosts[key]].append(host)
+        except KeyError:
+            first_hosts[key] = host
+            members[host] = [host]
+            render_list.append((host, host_task))
+    return render_list, members
+
+
+def iter_configs(env, jobs=1, host_tasks=None, render_each=False):
+    """
+    Render configs for all hosts matched by the task one by one.
+    :param env: Script environment.
+    :param jobs: Number of worker processes. Hosts are rendered in the current process if 1.
+    :param host_tasks: Hosts to render as returned by build_host_tasks(). All hosts of the task if not specified.
+    :param render_each: Render every host, even if the config of the same host class is already rendered.
+    :return: Generator of (host, configuration, error) tuples grouped by host class. Configuration is False and
+    error contains the message if the host config can not be rendered.
+    """
+    if host_tasks is None:
+        host_tasks = build_host_tasks(env)
+    render_list, members = split_classes(host_tasks, render_each)
+    for host, configuration, error in render_configs(env, render_list, jobs):
+        for member in members[host]:
+            yield member, configuration, error
+
+
+def render_configs(env, host_tasks, jobs=1):
+    # render a list of (host, host task) tuples in the current process or in a process pool
+    template_cache = get_template_cache(env)
+    if jobs > 1 and len(host_tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        from collections import deque
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(env.template_cache_size, env.bytecode_cache, profiler.active)) as executor:
+            pending = deque()
+            for chunk in split_chunks(host_tasks, jobs):
+                pending.append(executor.submit(_render_chunk_in_worker, chunk))
+                if len(pending) >= jobs * 2:
+                    for e in _chunk_result(pending.popleft(), template_cache):
+                        yield e
+            while pending:
+                for e in _chunk_result(pending.popleft(), template_cache):
+                    yield e
+    else:
+        for host, host_task in host_tasks:
+            for e in render_chunk(template_cache, [(host, host_task)]):
+                yield e
+
+
+def build_configs(env, jobs=1):
+    """
+    Render configs for all hosts matched by the task.
+    :param env: Script environment.
+    :param jobs: Number of worker processes. Hosts are rendered in the current process if 1.
+    :return: Dictionary with host IDs as keys. Failed hosts have an error message in the 'error' slot.
+    """
+    configs = dict()
+    for host, configuration, error in iter_configs(env, jobs=jobs):
+        configs[host] = dict()
+        configs[host]['configuration'] = configuration
+        configs[host]['error'] = error
+        configs[host]['mode'] = False
+        configs[host]['login'] = False
+        configs[host]['password'] = False
+    return configs
+
+
+def get_config_writer(env):
+    # single bundle for the whole run or a file per host
+    if env.bundle:
+        return BundleWriter(env.configs_path, env.prefix, env.bundle)
+    return ConfigWriter(env.configs_path, env.prefix, skip_unchanged=not env.force)
+
+
+def write_configs(env, host_tasks, writer):
+    # write every config as soon as it is rendered, yields (host, config filename, error) tuples
+    for ip, configuration, error in iter_configs(env, jobs=env.jobs, host_tasks=host_tasks,
+                                                 render_each=env.render_each):
+        if error:
+            yield ip, False, error
+            continue
+        if profiler.active:
+            start = perf_counter()
+        try:
+            realpath, written = writer.write(ip, configuration)
+        except OSError as e:
+            yield ip, False, 'Can not write config: %s' % e
+            continue
+        if profiler.active and written:
+            profiler.add('write_config', perf_counter() - start, len(configuration))
+        yield ip, realpath, False
+
+
+def stream_configs(env, host_tasks, writer):
+    # render every host config straight into its file, yields (host, config filename, error) tuples
+    template_cache = get_template_cache(env)
+    for ip, host_task in host_tasks.items():
+        try:
+            realpath, file = writer.open_temp(ip)
+        except OSError as e:
+            yield ip, False, 'Can not write config: %s' % e
+            continue
+        try:
+            write_host(template_cache, host_task, file)
+            file.close()
+        except Exception as e:
             file.close()
+            writer.discard(realpath)
+            yield ip, False, str(e) or e.__class__.__name__
+            continue
+        try:
+            realpath, _ = writer.commit(ip, realpath)
+        except OSError as e:
+            yield ip, False, 'Can not write config: %s' % e
+        else:
+            yield ip, realpath, False
+
+
+def save_configs(env):
+    # configs are written as soon as they are rendered, only a few configs are kept in memory
+    with profiler.stage('build_host_tasks'):
+        host_tasks = build_host_tasks(env)
+    manifest = False
+    if env.incremental:
+        # render only hosts with changed templates or variables
+        with profiler.stage('check_manifest'):
+            from modules.manifest import Manifest  # template extraction is required by incremental mode only
+            manifest = Manifest(env.configs_path, env.filename)
+            host_count = len(host_tasks)
+            host_tasks = {host: host_task for host, host_task in host_tasks.items()
+                          if manifest.changed(host, host_task, env.prefix)}
+        print('Incremental: %d host(s) to render, %d unchanged.' % (len(host_tasks), host_count - len(host_tasks)),
+              file=sys.stderr)
+
+    writer = get_config_writer(env)
+    if env.stream:
+        result_list = stream_configs(env, host_tasks, writer)
+    else:
+        result_list = write_configs(env, host_tasks, writer)
+
+    failed = 0
+    for ip, realpath, error in result_list:
+        if error:
+            failed += 1
+            print('ERROR: %s: %s' % (ip, error), file=sys.stderr)
+            if manifest:
+                manifest.failed(ip)
+        elif manifest:
+            manifest.saved(ip, realpath)
+    try:
+        writer.close()
+    except OSError as e:
+        sys.exit('ERROR: Can not write config bundle: %s' % e)
+    if manifest:
+        manifest.save()
+    print('Configs: %d written, %d unchanged.' % (writer.written, writer.unchanged), file=sys.stderr)
+
+    if env.cache_stats:
+        print('Template cache: %(hits)d hits, %(misses)d misses, %(templates)d templates, '
+              '%(environments)d environments.' % get_template_cache(env).stats(), file=sys.stderr)
+        print('Host classes: %d for %d host(s).' % (len(set(id(host_task) for host_task in host_tasks.values())),
+                                                    len(host_tasks)), file=sys.stderr)
+    if failed:
+        sys.exit('ERROR: Not able to build configs for %d host(s)!' % failed)
+
+
+def push_configs(env):
+    """
+    Render configs for all hosts matched by the task and push them to devices.
+    :param env: Script environment. Transport and engine parameters are taken from env.delivery.
+    :return: None
+    """
+    from modules.push import PushEngine  # asyncio engine is required in push mode only
+    engine = PushEngine(env.delivery)
+    with profiler.stage('build_host_tasks'):
+        host_tasks = build_host_tasks(env)
+
+    failed = 0
+    configs = list()
+    for ip, configuration, error in iter_configs(env, jobs=env.jobs, host_tasks=host_tasks,
+                                                 render_each=env.render_each):
+        if error:
+            failed += 1
+            print('ERROR: %s: %s' % (ip, error), file=sys.stderr)
+        else:
+            configs.append((ip, configuration))
+
+    start = perf_counter()
+    with profiler.stage('push'):
+        result_list = engine.run(configs)
+    elapsed = perf_counter() - start
+    for result in result_list:
+        if result['ok']:
+            print('%(host)s: OK, %(commands)d command(s), %(attempts)d attempt(s), %(elapsed).3f s' % result)
+        else:
+            failed += 1
+            print('ERROR: %(host)s: %(error)s (%(attempts)d attempt(s))' % result, file=sys.stderr)
+    print('Push: %d host(s) in %.3f s, %d request(s) over %d connection(s).' % (
+        len(result_list), elapsed, engine.requests, engine.pool.opened), file=sys.stderr)
+
+    if env.report:
+        with open(env.report, mode='w') as file:
+            json.dump(result_list, file, indent=1, sort_keys=True)
+    if failed:
+        sys.exit('ERROR: Not able to push configs to %d host(s)!' % failed)
 
 
-def ssh():
-    pass
+def ssh(env):
+    env.delivery = dict(env.delivery, transport='ssh')
+    push_configs(env)
 
 
-def eapi():
-    pass
+def eapi(env):
+    env.delivery = dict(env.delivery, transport='eapi')
+    push_configs(env)
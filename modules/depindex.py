@@ -0,0 +1,300 @@
+__author__ = 'Petr Ankudinov'
+
+from modules import delivery
+from modules.j2ASTwalker import J2Meta
+from modules.manifest import canonical_dump
+from modules.profiler import profiler
+from modules.validate import template_required_paths
+from bisect import bisect_left
+import hashlib
+import json
+import os
+import sys
+
+INDEX_FILENAME = '.j2p-index.json'
+
+
+def file_stamp(filename):
+    # modification time and size, a file is processed again only if one of them changes
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return False
+    return [stat.st_mtime, stat.st_size]
+
+
+def defined_paths(variables, prefix=''):
+    """
+    Paths defined by a variable block, including every intermediate path.
+    :param variables: Variable dictionary.
+    :param prefix: Path of the dictionary.
+    :return: Set of dotted variable paths, list elements are marked with [].
+    """
+    paths = set()
+    for key, value in variables.items():
+        path = prefix + str(key)
+        paths.add(path)
+        if isinstance(value, dict):
+            paths.update(defined_paths(value, path + '.'))
+        elif isinstance(value, list):
+            paths.add(path + '[]')
+            for element in value:
+                if isinstance(element, dict):
+                    paths.update(defined_paths(element, path + '[].'))
+    return paths
+
+
+def parent_paths(path):
+    # every path the variable is a part of, e.g. vxlan and vxlan.loopback for vxlan.loopback.mask
+    parents = list()
+    for position, character in enumerate(path):
+        if character == '.' and path[position - 1:position] != ']':
+            parents.append(path[:position])
+        elif character == '[':
+            parents.append(path[:position])
+        elif character == ']':
+            parents.append(path[:position + 1])
+    return parents
+
+
+class DependencyIndex:
+    """
+    Reverse index from templates and variables to hosts.
+    Hosts matched by the same task blocks form a class, the index keeps task blocks and templates of every class,
+    variable paths defined by every task block and variable paths used by every template including all templates
+    included by it. The index is saved in the configs directory and updated incrementally: hosts are matched again
+    only if the host db or tags of task blocks changed, a task block is processed again only if its digest changed
+    and a template is parsed again only if one of the included template files changed.
+    """
+
+    def __init__(self, configs_path, task_filename, template_path):
+        self.realpath = os.path.join(configs_path, INDEX_FILENAME)
+        self.task_key = os.path.realpath(task_filename)
+        self.template_path = template_path
+        try:
+            with open(self.realpath, mode='r') as file:
+                self.data = json.load(file)
+        except Exception as _:  # missing or broken index, everything is processed again
+            self.data = dict()
+        self.entry = self.data.get(self.task_key, dict())
+        self.updated = {'classes': False, 'blocks': 0, 'templates': 0}
+        self.errors = list()
+        self.build_reverse_index()
+
+    # update
+
+    def update(self, env):
+        """
+        Bring the index up to date with the host db, the task file and the templates.
+        :param env: Script environment with loaded host db and task.
+        :return: True if anything changed.
+        """
+        entry = self.entry
+        # hosts are matched again only if the host db or tags of task blocks changed, not if variables changed
+        selection = hashlib.sha256(canonical_dump([
+            [block['tags'], 'variables' in block.keys(), 'templates' in block.keys()] for block in env.json_data
+        ]).encode()).hexdigest()
+        stamps = [file_stamp(env.db_name), selection]
+        if entry.get('stamps') != stamps:
+            with profiler.stage('index_classes'):
+                classes = delivery.host_classes(env)
+                entry['classes'] = [{'blocks': list(signature), 'hosts': [str(host) for host in hosts]}
+                                    for signature, hosts in classes.items()]
+            self.updated['classes'] = True
+
+        # variable paths of every task block, unchanged blocks are found by digest
+        with profiler.stage('index_blocks'):
+            known_blocks = {block['digest']: block for block in entry.get('blocks', list())}
+            blocks = list()
+            for block in env.json_data:
+                digest = hashlib.sha256(canonical_dump(block).encode()).hexdigest()
+                try:
+                    blocks.append(known_blocks[digest])
+                except KeyError:
+                    blocks.append({
+                        'digest': digest,
+                        'paths': sorted(defined_paths(block.get('variables') or dict())),
+                        'templates': [self.template_key(*delivery.template_location(self.template_path, j2))
+                                      for j2 in block.get('templates') or list()],
+                    })
+                    self.updated['blocks'] += 1
+            entry['blocks'] = blocks
+
+        # variable paths and included files of every template used by the task
+        with profiler.stage('index_templates'):
+            known_templates = entry.get('templates', dict())
+            templates = dict()
+            for block in blocks:
+                for template in block['templates']:
+                    if template in templates:
+                        continue
+                    try:
+                        previous = known_templates[template]
+                    except KeyError:
+                        previous = False
+                    if previous and all(file_stamp(filename) == stamp for filename, stamp in previous['files']):
+                        templates[template] = previous
+                    else:
+                        templates[template] = self.index_template(template)
+                        self.updated['templates'] += 1
+            entry['templates'] = templates
+
+        for template, template_entry in entry['templates'].items():
+            if template_entry.get('error'):
+                self.errors.append('%s: %s' % (template, template_entry['error']))
+        entry['stamps'] = stamps
+        changed = self.updated['classes'] or self.updated['blocks'] or self.updated['templates']
+        if changed or self.task_key not in self.data:
+            self.data[self.task_key] = entry
+            self.build_reverse_index()
+        return bool(changed)
+
+    def template_key(self, template_search_path, template_filename):
+        # template name relative to the template directory, realpath for templates outside of it
+        realpath = os.path.realpath(os.path.join(template_search_path, template_filename))
+        template_dir = os.path.realpath(self.template_path)
+        if realpath.startswith(template_dir + os.sep):
+            return os.path.relpath(realpath, template_dir)
+        return realpath
+
+    def template_realpath(self, template):
+        return os.path.join(os.path.realpath(self.template_path), template)
+
+    def index_template(self, template):
+        # included templates and used variable paths of a template, errors are kept in the index
+        realpath = self.template_realpath(template)
+        files = [[realpath, file_stamp(realpath)]]
+        try:
+            template_meta = J2Meta(realpath)
+            included = list()
+            for name in sorted(template_meta.get_template_list()):
+                filename = template_meta.ast_cache.get_filename(template_meta.env, name)
+                if filename and filename != realpath:
+                    included.append(self.template_key(os.path.dirname(filename), os.path.basename(filename)))
+                    files.append([filename, file_stamp(filename)])
+            return {
+                'files': files,
+                'included': included,
+                'paths': template_required_paths(template_meta),
+            }
+        except Exception as e:
+            return {'files': files, 'included': list(), 'paths': list(), 'error': str(e) or e.__class__.__name__}
+
+    def save(self):
+        temp_realpath = self.realpath + '.tmp'
+        with open(temp_realpath, mode='w') as file:
+            json.dump(self.data, file, sort_keys=True)
+        os.replace(temp_realpath, self.realpath)
+
+    # queries
+
+    def build_reverse_index(self):
+        # template: class numbers, variable path: class numbers and task block numbers
+        entry = self.entry
+        self.template_classes = dict()
+        self.path_classes = dict()
+        self.path_blocks = dict()
+        blocks = entry.get('blocks', list())
+        templates = entry.get('templates', dict())
+        for number, block in enumerate(blocks):
+            for path in block['paths']:
+                self.path_blocks.setdefault(path, list()).append(number)
+        for class_number, host_class in enumerate(entry.get('classes', list())):
+            class_templates = set()
+            for number in host_class['blocks']:
+                for template in blocks[number]['templates'] if number < len(blocks) else list():
+                    class_templates.add(template)
+                    class_templates.update(templates.get(template, dict()).get('included', list()))
+            class_paths = set()
+            for template in class_templates:
+                self.template_classes.setdefault(template, list()).append(class_number)
+                template_entry = templates.get(template)
+                if template_entry:
+                    class_paths.update(template_entry['paths'])
+            for path in class_paths:
+                self.path_classes.setdefault(path, list()).append(class_number)
+        self.paths = sorted(self.path_classes)
+
+    def class_hosts(self, class_numbers):
+        classes = self.entry['classes']
+        return [host for number in sorted(set(class_numbers)) for host in classes[number]['hosts']]
+
+    def template_hosts(self, template):
+        """
+        Find hosts rendering a template directly or through includes.
+        :param template: Template filename relative to the template directory or a path to the template file.
+        :return: List of host IDs.
+        """
+        if os.path.isfile(template):
+            template = self.template_key(os.path.dirname(template), os.path.basename(template))
+        return self.class_hosts(self.template_classes.get(template, list()))
+
+    def variable_blocks(self, path):
+        # numbers of task blocks defining the variable
+        return list(self.path_blocks.get(path, list()))
+
+    def variable_classes(self, path):
+        # classes using the variable, a part of it (vxlan.loopback.mask for vxlan.loopback) or a dictionary with it
+        class_numbers = list()
+        for parent in parent_paths(path) + [path]:
+            class_numbers.extend(self.path_classes.get(parent, list()))
+        position = bisect_left(self.paths, path)
+        while position < len(self.paths) and self.paths[position].startswith(path):
+            child = self.paths[position]
+            if child != path and child[len(path)] in '.[':
+                class_numbers.extend(self.path_classes[child])
+            position += 1
+        return class_numbers
+
+    def variable_hosts(self, path):
+        """
+        Find hosts affected by a change of a variable in the task.
+        :param path: Dotted variable path, e.g. vxlan.loopback.mask or vlan_list[].vni
+        :return: List of host IDs using the variable and matched by a task block defining it.
+        """
+        blocks = set(self.variable_blocks(path))
+        classes = self.entry['classes']
+        return self.class_hosts(number for number in self.variable_classes(path)
+                                if blocks.intersection(classes[number]['blocks']))
+
+    def stats(self):
+        return {
+            'hosts': sum(len(host_class['hosts']) for host_class in self.entry.get('classes', list())),
+            'classes': len(self.entry.get('classes', list())),
+            'blocks': len(self.entry.get('blocks', list())),
+            'templates': len(self.template_classes),
+            'paths': len(self.paths),
+        }
+
+
+def query_index(env):
+    """
+    Update the dependency index and print hosts affected by template and variable changes.
+    :param env: Script environment.
+    :return: None
+    """
+    index = DependencyIndex(env.configs_path, env.filename, env.template_path)
+    with profiler.stage('index_update'):
+        if index.update(env):
+            index.save()
+    for error in index.errors:
+        print('ERROR: %s' % error, file=sys.stderr)
+    print('Index: %(hosts)d host(s) in %(classes)d class(es), %(blocks)d block(s), %(templates)d template(s), '
+          '%(paths)d variable path(s).' % index.stats(), file=sys.stderr)
+    print('Updated: %s, %d block(s), %d template(s).' % (
+        'host classes' if index.updated['classes'] else 'no host classes', index.updated['blocks'],
+        index.updated['templates']), file=sys.stderr)
+
+    hosts = set()
+    for template in env.index_templates:
+        template_hosts = index.template_hosts(template)
+        print('Template %s: %d host(s).' % (template, len(template_hosts)), file=sys.stderr)
+        hosts.update(template_hosts)
+    for path in env.index_variables:
+        variable_hosts = index.variable_hosts(path)
+        print('Variable %s: defined in block(s) %s, %d host(s).' % (
+            path, ', '.join(str(number) for number in index.variable_blocks(path)) or 'none', len(variable_hosts)),
+            file=sys.stderr)
+        hosts.update(variable_hosts)
+    for host in sorted(hosts):
+        print(host)
@@ -0,0 +1,205 @@
+__author__ = 'Petr Ankudinov'
+
+from array import array
+from itertools import compress
+
+MASK_BITS = 64  # number of most frequent tags kept as a bitmask of every host
+BIT_SELECTORS = bytes.maketrans(b'01', b'\x00\x01')
+
+
+def bit_positions(value):
+    # numbers of set bits in an integer, lowest first
+    bits = bin(value)[:1:-1]
+    positions = list()
+    position = bits.find('1')
+    while position >= 0:
+        positions.append(position)
+        position = bits.find('1', position + 1)
+    return positions
+
+
+def bitset(numbers, size):
+    # integer with the specified bits set, built in linear time
+    buffer = bytearray((size + 7) // 8)
+    for number in numbers:
+        buffer[number >> 3] |= 1 << (number & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+class HostDB:
+    """
+    Host database with interned tags.
+    Every tag gets an integer ID, IDs are assigned by tag frequency. The most frequent tags (any, switch, site, etc.)
+    are kept as a 64 bit mask for every host and as a bitset of host numbers for every tag.
+    Remaining tags (host names, MLAG pairs) are kept in flat arrays of tag IDs per host and host numbers per tag.
+    Read access is compatible with the dictionary loaded from the db file, except that tags of a host are returned
+    once each and in tag ID order.
+    """
+
+    def __init__(self, json_db):
+        counts = dict()
+        for tags in json_db.values():
+            for tag in set(tags or ()):
+                counts[tag] = counts.get(tag, 0) + 1
+        self.tags = sorted(counts, key=lambda e: -counts[e])  # tag ID: tag, same count tags keep db order
+        self.tag_ids = {tag: tag_id for tag_id, tag in enumerate(self.tags)}
+        self.frequent = min(MASK_BITS, len(self.tags))  # tag IDs below are frequent
+
+        self.hosts = list()  # host number: host ID
+        self.numbers = dict()  # host ID: host number
+        self.masks = array('Q')  # host number: bitmask of frequent tag IDs
+        self.rare_offsets = array('I', [0])  # host number: start of host rare tag IDs in rare_tags
+        self.rare_tags = array('I')
+        frequent_hosts = [list() for _ in range(self.frequent)]
+        for host, tags in json_db.items():
+            number = len(self.hosts)
+            tag_id = self.tag_ids.get(host)
+            self.hosts.append(self.tags[tag_id] if tag_id is not None else host)  # host name is often a tag
+            self.numbers[self.hosts[number]] = number
+            mask = 0
+            for tag_id in sorted(set(self.tag_ids[tag] for tag in tags or ())):
+                if tag_id < self.frequent:
+                    mask |= 1 << tag_id
+                    frequent_hosts[tag_id].append(number)
+                else:
+                    self.rare_tags.append(tag_id)
+            self.masks.append(mask)
+            self.rare_offsets.append(len(self.rare_tags))
+        # hosts of every frequent tag as a bitset and as an array of host numbers
+        self.tag_hosts = [bitset(numbers, len(self.hosts)) for numbers in frequent_hosts]
+        self.frequent_postings = [array('I', numbers) for numbers in frequent_hosts]
+
+        # host numbers of every rare tag, counting sort of rare_tags by tag ID
+        self.posting_offsets = array('I', [0])
+        for tag in self.tags[self.frequent:]:
+            self.posting_offsets.append(self.posting_offsets[-1] + counts[tag])
+        self.postings = array('I', bytes(4 * len(self.rare_tags)))
+        positions = array('I', self.posting_offsets[:-1])
+        for number in range(len(self.hosts)):
+            for i in range(self.rare_offsets[number], self.rare_offsets[number + 1]):
+                rare_id = self.rare_tags[i] - self.frequent
+                self.postings[positions[rare_id]] = number
+                positions[rare_id] += 1
+        self.all_hosts = (1 << len(self.hosts)) - 1
+
+    # dictionary interface
+
+    def __getitem__(self, host):
+        number = self.numbers[host]
+        tag_ids = bit_positions(self.masks[number])
+        tag_ids.extend(self.rare_tags[self.rare_offsets[number]:self.rare_offsets[number + 1]])
+        return [self.tags[tag_id] for tag_id in tag_ids]
+
+    def __contains__(self, host):
+        return host in self.numbers
+
+    def __iter__(self):
+        return iter(self.hosts)
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def __eq__(self, other):
+        if isinstance(other, HostDB):
+            return self.hosts == other.hosts and self.to_dict() == other.to_dict()
+        return NotImplemented
+
+    def get(self, host, default=None):
+        try:
+            return self[host]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.numbers.keys()
+
+    def items(self):
+        return ((host, self[host]) for host in self.hosts)
+
+    def to_dict(self):
+        return {host: self[host] for host in self.hosts}
+
+    # tag queries
+
+    def split_tags(self, tags):
+        """
+        Convert tags to tag IDs.
+        :param tags: Iterable of tags.
+        :return: Tuple with a bitmask of frequent tag IDs and a sorted list of rare tag IDs.
+        None if one of the tags is not assigned to any host.
+        """
+        mask = 0
+        rare = set()
+        for tag in tags:
+            try:
+                tag_id = self.tag_ids[tag]
+            except KeyError:
+                return None
+            if tag_id < self.frequent:
+                mask |= 1 << tag_id
+            else:
+                rare.add(tag_id)
+        return mask, sorted(rare)
+
+    def host_has(self, number, mask, rare):
+        # bitwise issubset for the frequent tags, array lookup for the rare ones
+        if self.masks[number] & mask != mask:
+            return False
+        if rare:
+            host_rare = self.rare_tags[self.rare_offsets[number]:self.rare_offsets[number + 1]]
+            for tag_id in rare:
+                if tag_id not in host_rare:
+                    return False
+        return True
+
+    def has_tags(self, host, tags):
+        # the same as set(tags).issubset(db[host])
+        tag_ids = self.split_tags(tags)
+        return tag_ids is not None and self.host_has(self.numbers[host], *tag_ids)
+
+    def match(self, tags):
+        """
+        Find hosts that have all specified tags.
+        :param tags: Iterable of tags.
+        :return: List of host IDs in db order. Every host is matched if the tag list is empty.
+        """
+        tag_ids = self.split_tags(tags)
+        if tag_ids is None:
+            return list()
+        mask, rare = tag_ids
+        if rare:
+            # the rarest tag has the highest ID and the shortest host list, other tags are checked per host
+            rare_id = rare.pop() - self.frequent
+            return [self.hosts[number] for number in
+                    self.postings[self.posting_offsets[rare_id]:self.posting_offsets[rare_id + 1]]
+                    if self.host_has(number, mask, rare)]
+        tag_ids = bit_positions(mask)
+        if not tag_ids:
+            return list(self.hosts)
+        postings = min((self.frequent_postings[tag_id] for tag_id in tag_ids), key=len)
+        if len(postings) * 8 < len(self.hosts):
+            # few candidates, check the host bitmask of every candidate
+            masks = self.masks
+            return [self.hosts[number] for number in postings if masks[number] & mask == mask]
+        bits = self.all_hosts
+        for tag_id in tag_ids:
+            bits &= self.tag_hosts[tag_id]
+        # binary string of the bitset is used as a selector for the host list, no Python loop over hosts
+        return list(compress(self.hosts, bin(bits)[:1:-1].encode().translate(BIT_SELECTORS)))
+
+    def match_all(self, tag_sets):
+        """
+        Bulk query, evaluate many tag sets at once. Identical tag sets are matched once.
+        :param tag_sets: Iterable of tag iterables.
+        :return: List of host ID lists in tag set order.
+        """
+        results = dict()
+        result_list = list()
+        for tags in tag_sets:
+            key = frozenset(tags)
+            try:
+                result_list.append(results[key])
+            except KeyError:
+                results[key] = self.match(key)
+                result_list.append(results[key])
+        return result_list
@@ -3,34 +3,101 @@
 __author__ = 'Petr Ankudinov'
 
 from jinja2 import meta, FileSystemLoader
+from jinja2.defaults import DEFAULT_NAMESPACE
 import jinja2.nodes
 import os
 import sys
 import yaml
-from modules.tools import merge_dict, build_dict
-
-
-def build_dict_recursive(lst_or_tpl):
-    # Recursive function that builds a hierarchical dictionary from lists and sublists of (key_list, value) tuples.
-
-    if isinstance(lst_or_tpl, tuple):
-        if isinstance(lst_or_tpl[1], list):
-            value = list()
-            for e in lst_or_tpl[1]:
-                value.append(build_dict_recursive(e))
-        elif isinstance(lst_or_tpl[1], tuple):
-            value = build_dict_recursive(lst_or_tpl[1])
+from modules.tools import merge_dict, merge_list, build_dict
+from modules.profiler import profiler
+
+
+def build_value(value):
+    # value of a (key list, value) tuple in the variable dictionary
+    if isinstance(value, list):
+        return [build_value(e) if not isinstance(e, list) else VariableTrie(e).to_dict() for e in value]
+    if isinstance(value, tuple):
+        return VariableTrie([value]).to_dict()
+    return value
+
+
+class VariableTrie:
+    """
+    Incremental builder of the variable dictionary.
+    Every (key list, value) tuple found by the AST walk is inserted along its key path, the dictionary built so far
+    is not merged again for every tuple. Conflicting keys are resolved the same way as merge_dict() does.
+    """
+
+    def __init__(self, lst=None):
+        self.root = dict()
+        for e in lst or ():
+            self.add(e)
+
+    def add(self, lst_or_tpl):
+        if isinstance(lst_or_tpl, tuple):
+            self.insert(lst_or_tpl[0], lst_or_tpl[1])
         else:
-            value = lst_or_tpl[1]
-        result = build_dict(list(reversed(lst_or_tpl[0])), value)
-    elif isinstance(lst_or_tpl, list):
-        result = dict()
-        for e in lst_or_tpl:
-            result = merge_dict(result, build_dict_recursive(e))
+            for e in lst_or_tpl:
+                self.add(e)
+
+    def insert(self, key_list, value):
+        """
+        Insert a single variable, O(depth) unless the path ends in a list that has to be merged.
+        :param key_list: List of dictionary keys from the top level down.
+        :param value: Variable value from the AST walk.
+        """
+        value = build_value(value)
+        node = self.root
+        last = len(key_list) - 1
+        for depth, key in enumerate(key_list):
+            try:
+                current = node[key]
+            except KeyError:
+                node[key] = build_dict(list(reversed(key_list[depth + 1:])), value)
+                return
+            if depth == last:
+                # conflicts are resolved the same way as merge_dict() does
+                if isinstance(current, dict) and isinstance(value, dict):
+                    node[key] = merge_dict(current, value)
+                elif isinstance(current, list) or isinstance(value, list):
+                    node[key] = merge_list(current, value)
+                else:
+                    node[key] = value
+            elif isinstance(current, dict):
+                node = current  # every dictionary in the trie is owned by it, no copy on write
+            elif isinstance(current, list):
+                node[key] = merge_list(current, build_dict(list(reversed(key_list[depth + 1:])), value))
+                return
+            else:
+                node[key] = build_dict(list(reversed(key_list[depth + 1:])), value)
+                return
+
+    def to_dict(self):
+        return self.root
+
+
+def iter_paths(key_list, value):
+    """
+    Flatten a (key list, value) tuple from the AST walk.
+    :param key_list: List of dictionary keys.
+    :param value: Variable value from the AST walk.
+    :return: Generator of dotted variable paths, list elements are marked with [], e.g. vlan_list[].number
+    """
+    path = '.'.join(key_list)
+    if isinstance(value, tuple):
+        for child_path in iter_paths(*value):
+            yield path + '.' + child_path
+    elif isinstance(value, list):
+        found = False
+        for e in value:
+            for tpl in (e if isinstance(e, list) else [e] if isinstance(e, tuple) else []):
+                for child_path in iter_paths(*tpl):
+                    found = True
+                    yield path + '[].' + child_path
+        if not found:  # list of values without attributes
+            yield path + '[]'
     else:
-        result = lst_or_tpl
-
-    return result
+        yield path
 
 
 value_dict = {
@@ -41,106 +108,212 @@ value_dict = {
 }
 
 
+# Walk over child nodes of these nodes
+recursion_required_nodes = [jinja2.nodes.Template, jinja2.nodes.Output]
+
+# Node specific walk, J2Meta method names
+walk_handlers = [
+    (jinja2.nodes.For, 'walk_for'),
+    (jinja2.nodes.If, 'walk_if'),
+    (jinja2.nodes.Getattr, 'walk_getattr'),
+    (jinja2.nodes.Assign, 'j2_ast_walk_assign'),
+    (jinja2.nodes.Name, 'j2_ast_walk_name'),
+]
+
+# Following nodes are ignored: TemplateData, Literal, Expr, Const, Include.
+# Generate alert for these nodes for future debugging
+alert_nodes_list = [
+    jinja2.nodes.Macro,
+    jinja2.nodes.CallBlock,
+    jinja2.nodes.FilterBlock,
+    jinja2.nodes.With,
+    jinja2.nodes.Block,
+    jinja2.nodes.Import,
+    jinja2.nodes.FromImport,
+    jinja2.nodes.ExprStmt,
+    jinja2.nodes.AssignBlock,
+    jinja2.nodes.BinExpr,
+    jinja2.nodes.UnaryExpr,
+    jinja2.nodes.Tuple,
+    jinja2.nodes.List,
+    jinja2.nodes.Dict,
+    jinja2.nodes.Pair,
+    jinja2.nodes.Keyword,
+    jinja2.nodes.CondExpr,
+    jinja2.nodes.Filter,
+    jinja2.nodes.Test,
+    jinja2.nodes.Call,
+    jinja2.nodes.Getitem,
+    jinja2.nodes.Slice,
+    jinja2.nodes.Concat,
+    jinja2.nodes.Compare,
+    jinja2.nodes.Operand,
+]
+
+# Names provided by Jinja2, never taken from template variables: range, namespace, loop.index, etc.
+builtin_names = set(DEFAULT_NAMESPACE) | {'loop', 'caller', 'varargs', 'kwargs', 'self', 'super'}
+
+
+class TemplateASTCache:
+    """
+    Parsed templates and referenced template names shared between J2Meta instances.
+    Every template file is parsed once, entries are invalidated when the file modification time changes.
+    """
+
+    def __init__(self):
+        self.entries = dict()  # template file realpath: (mtime, parsed template, referenced template names)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_filename(env, template_name):
+        # find template file the same way FileSystemLoader does, without reading it
+        for search_path in env.loader.searchpath:
+            filename = os.path.join(search_path, *template_name.split('/'))
+            if os.path.isfile(filename):
+                return os.path.realpath(filename)
+        return False
+
+    def get(self, env, template_name):
+        """
+        Get parsed template.
+        :param env: Jinja2 environment with FileSystemLoader.
+        :param template_name: Template name relative to the loader search path.
+        :return: Tuple with parsed template and a tuple of referenced template names.
+        """
+        filename = self.get_filename(env, template_name)
+        if filename:
+            mtime = os.path.getmtime(filename)
+            try:
+                entry = self.entries[filename]
+            except KeyError:
+                pass
+            else:
+                if entry[0] == mtime:
+                    self.hits += 1
+                    return entry[1], entry[2]
+        self.misses += 1
+        with profiler.stage('parse_template'):
+            template_src, filename, _ = env.loader.get_source(env, template_name)  # raises TemplateNotFound
+            mtime = os.path.getmtime(filename)
+            parsed_template = env.parse(source=template_src)
+        referenced_template_list = tuple(meta.find_referenced_templates(parsed_template))
+        self.entries[os.path.realpath(filename)] = (mtime, parsed_template, referenced_template_list)
+        return parsed_template, referenced_template_list
+
+
+ast_cache = TemplateASTCache()  # default cache shared by all J2Meta instances
+
+
 class J2Meta:
 
-    def __init__(self, template_realpath):
+    dispatch_table = dict()  # node class: walk action, see get_node_action()
+
+    def __init__(self, template_realpath, template_ast_cache=None):
         self.env = jinja2.Environment(loader=FileSystemLoader(searchpath=os.path.dirname(template_realpath)))
+        self.ast_cache = template_ast_cache or ast_cache
         self.parent_template = os.path.basename(template_realpath)
-        self.known_templates = self.get_known_templates(self.parent_template)
+        self._known_templates = None  # include graph is walked on first use
+
+    @property
+    def known_templates(self):
+        if self._known_templates is None:
+            self._known_templates = self.get_known_templates(self.parent_template)
+        return self._known_templates
 
     # INTERNAL methods
 
-    def get_known_templates(self, template_name):
-        # initialise known template list and append parent template name
+    def iter_templates(self, template_name):
+        # parsed parent template and all referenced templates, a template is parsed only when the previous one was read
         known_template_list = set()
         known_template_list.add(template_name)
-        # parse parent template
-        template_src = self.env.loader.get_source(self.env, template_name)[0]
-        parsed_template = self.env.parse(source=template_src)
-        # get referenced templates and walk over these templates recursively
-        referenced_template_list = meta.find_referenced_templates(parsed_template)
-        for child_template in referenced_template_list:
-            known_template_list.add(child_template)
-            known_template_list.update(self.get_known_templates(child_template))
+        # walk over referenced templates, every template is visited once even if included many times
+        template_stack = [template_name]
+        while template_stack:
+            name = template_stack.pop()
+            parsed_template, referenced_template_list = self.ast_cache.get(self.env, name)
+            yield name, parsed_template
+            for child_template in referenced_template_list:
+                if child_template is None:  # dynamic include, name is not known before rendering
+                    continue
+                if child_template not in known_template_list:
+                    known_template_list.add(child_template)
+                    template_stack.append(child_template)
+
+    def get_known_templates(self, template_name):
         # return parent and all child template names
-        return known_template_list
+        return set(name for name, _ in self.iter_templates(template_name))
+
+    @classmethod
+    def get_node_action(cls, node_type):
+        """
+        Find out how to walk over a node of a specific type. Results are cached in the dispatch table.
+        :param node_type: Jinja2 node class.
+        :return: Tuple (children, handler name list, alert node list). If children is True, child nodes are walked.
+        """
+        try:
+            return cls.dispatch_table[node_type]
+        except KeyError:
+            if issubclass(node_type, tuple(recursion_required_nodes)):
+                action = (True, [], [])
+            else:
+                handlers = [handler for node, handler in walk_handlers if issubclass(node_type, node)]
+                alerts = [node for node in alert_nodes_list if issubclass(node_type, node)]
+                action = (False, handlers, alerts)
+            cls.dispatch_table[node_type] = action
+            return action
+
+    def j2_ast_walk(self, walker):
+        # Drive walker generators. Child node walks are kept on an explicit stack instead of Python recursion.
+        stack = [walker]
+        result_list = None
+        while True:
+            try:
+                child_node = stack[-1].send(result_list)
+            except StopIteration as stop:
+                stack.pop()
+                result_list = stop.value
+                if not stack:
+                    return result_list
+            else:
+                stack.append(self.walk_node(child_node))
+                result_list = None
 
-    def j2_ast_walk_main(self, j2node):
-        # The script will start walking over Jinja2 AST here looking for Getattr, Assign, Name, For nodes.
+    def walk_node(self, j2node):
+        # Walker generator for a single node. Yields child nodes and receives list of results for each of them.
+        children, handlers, alerts = self.get_node_action(type(j2node))
         result_list = list()
-        recursion_required_nodes = [jinja2.nodes.Template, jinja2.nodes.Output]
-        recursion_required = False
-        for node in recursion_required_nodes:
-            if isinstance(j2node, node):
-                recursion_required = True
-        if recursion_required:
+        if children:
             for child_node in j2node.iter_child_nodes():
-                # Recursion to get more specific nodes
-                for e in self.j2_ast_walk_main(child_node):
-                    result_list.append(e)
+                result_list.extend((yield child_node))
         else:
-            # Node specific walk
-            if isinstance(j2node, jinja2.nodes.For):
-                for e in self.j2_ast_walk_for(j2node):
-                    result_list.append(e)
-            if isinstance(j2node, jinja2.nodes.If):
-                for e in self.j2_ast_walk_if(j2node):
-                    result_list.append(e)
-            if isinstance(j2node, jinja2.nodes.Getattr):
-                for e in self.j2_ast_walk_getattr(j2node):
-                    result_list.append(e)
-            if isinstance(j2node, jinja2.nodes.Assign):
-                for e in self.j2_ast_walk_assign(j2node):
-                    result_list.append(e)
-            if isinstance(j2node, jinja2.nodes.Name):
-                for e in self.j2_ast_walk_name(j2node):
-                    result_list.append(e)
-            # Ignore following nodes
-            ignored_node_list = [
-                jinja2.nodes.TemplateData,
-                jinja2.nodes.Literal,
-                jinja2.nodes.Expr,
-                jinja2.nodes.Const,
-                jinja2.nodes.Include,
-            ]
-            for ignored_node in ignored_node_list:
-                if isinstance(j2node, ignored_node):
-                    pass  # do nothing
-            # Generate alert for future debugging
-            alert_nodes_list = [
-                jinja2.nodes.Macro,
-                jinja2.nodes.CallBlock,
-                jinja2.nodes.FilterBlock,
-                jinja2.nodes.With,
-                jinja2.nodes.Block,
-                jinja2.nodes.Import,
-                jinja2.nodes.FromImport,
-                jinja2.nodes.ExprStmt,
-                jinja2.nodes.AssignBlock,
-                jinja2.nodes.BinExpr,
-                jinja2.nodes.UnaryExpr,
-                jinja2.nodes.Tuple,
-                jinja2.nodes.List,
-                jinja2.nodes.Dict,
-                jinja2.nodes.Pair,
-                jinja2.nodes.Keyword,
-                jinja2.nodes.CondExpr,
-                jinja2.nodes.Filter,
-                jinja2.nodes.Test,
-                jinja2.nodes.Call,
-                jinja2.nodes.Getitem,
-                jinja2.nodes.Slice,
-                jinja2.nodes.Concat,
-                jinja2.nodes.Compare,
-                jinja2.nodes.Operand,
-            ]
-            for i, ignored_node in enumerate(alert_nodes_list):
-                if isinstance(j2node, ignored_node):
-                    print("Ignoring %s!" % alert_nodes_list[i], file=sys.stderr)
-                    print(j2node, file=sys.stderr)
-
+            for handler in handlers:
+                handler_result = getattr(self, handler)(j2node)
+                if not isinstance(handler_result, list):  # walker generator
+                    handler_result = yield from handler_result
+                result_list.extend(handler_result)
+            for alert_node in alerts:
+                # Generate alert for future debugging
+                print("Ignoring %s!" % alert_node, file=sys.stderr)
+                print(j2node, file=sys.stderr)
         return result_list
 
+    def iter_ast(self, j2node):
+        # The script will start walking over Jinja2 AST here looking for Getattr, Assign, Name, For nodes.
+        # Results are yielded as soon as every top level statement is walked.
+        node_stack = [iter([j2node])]
+        while node_stack:
+            try:
+                node = next(node_stack[-1])
+            except StopIteration:
+                node_stack.pop()
+                continue
+            if self.get_node_action(type(node))[0]:
+                node_stack.append(node.iter_child_nodes())
+            else:
+                for e in self.j2_ast_walk(self.walk_node(node)):
+                    yield e
+
     @staticmethod
     def j2_ast_walk_name(j2node):
         key_list = [j2node.name]
@@ -154,11 +327,10 @@ class J2Meta:
         key_list = list(key_list)
         return [(key_list, value)]  # return a list with a single tuple
 
-    def j2_ast_walk_getattr(self, j2node):
+    def walk_getattr(self, j2node):
         result_list = list()
         for child_node in j2node.iter_child_nodes():
-            for e in self.j2_ast_walk_main(child_node):
-                result_list.append(e)
+            result_list.extend((yield child_node))
         for tpl in result_list:
             tpl[0].append(j2node.attr)  # add parent key to each tuple
         return result_list
@@ -189,16 +361,16 @@ class J2Meta:
         key_list = list(reversed(key_list))
         return [(key_list, value)]
 
-    def j2_ast_walk_for(self, j2node):
+    def walk_for(self, j2node):
         result_list = list()
-        iter_list = self.j2_ast_walk_main(j2node.iter)
+        iter_list = yield j2node.iter
 
-        target_key_list = self.j2_ast_walk_main(j2node.target)  # value will be ignored
+        target_key_list = yield j2node.target  # value will be ignored
         target_key_length = len(target_key_list)
 
         target_child_key_list = list()
         for node in j2node.body:
-            for e in self.j2_ast_walk_main(node):
+            for e in (yield node):
                 for tk in target_key_list:
                     if e[0][:target_key_length] == tk[0]:
                         if e[0][target_key_length:]:  # verify if there are any other key apart from target
@@ -213,20 +385,17 @@ class J2Meta:
 
         return result_list
 
-    def j2_ast_walk_if(self, j2node):
+    def walk_if(self, j2node):
         result_list = list()
 
         if isinstance(j2node.test, jinja2.nodes.Compare):
-            for key_list, value in self.j2_ast_walk_getattr(j2node.test.expr):
-                result_list.append((key_list, value))
+            result_list.extend((yield from self.walk_getattr(j2node.test.expr)))
 
         for node in j2node.body:
-            for key_list, value in self.j2_ast_walk_main(node):
-                result_list.append((key_list, value))
+            result_list.extend((yield node))
 
         for node in j2node.else_:
-            for key_list, value in self.j2_ast_walk_main(node):
-                result_list.append((key_list, value))
+            result_list.extend((yield node))
 
         return result_list
 
@@ -235,22 +404,92 @@ class J2Meta:
     def get_template_list(self):
         return self.known_templates
 
+    def get_local_names(self):
+        """
+        Find names defined inside the parent template and all referenced templates.
+        :return: Set of set and for targets, macro names and arguments and import targets.
+        """
+        local_names = set()
+        for _, parsed_template in self.iter_templates(self.parent_template):
+            for node in parsed_template.find_all((jinja2.nodes.Name, jinja2.nodes.Macro, jinja2.nodes.Import,
+                                                  jinja2.nodes.FromImport)):
+                if isinstance(node, jinja2.nodes.Name):
+                    if node.ctx in ['store', 'param']:
+                        local_names.add(node.name)
+                elif isinstance(node, jinja2.nodes.Macro):
+                    local_names.add(node.name)
+                elif isinstance(node, jinja2.nodes.Import):
+                    local_names.add(node.target)
+                else:
+                    for name in node.names:
+                        local_names.add(name[1] if isinstance(name, tuple) else name)
+        return local_names
+
     def parse(self, variables):
         j2_template = self.env.get_template(self.parent_template)  # get parent template
         config = j2_template.render(variables)
         return config
 
-    def get_variables(self):
-        result_list = list()
-        for template in self.known_templates:
-            template_src = self.env.loader.get_source(self.env, template)[0]
-            parsed_template = self.env.parse(source=template_src)
-            for e in self.j2_ast_walk_main(parsed_template):
-                result_list.append(e)
-
-        var_dict = build_dict_recursive(result_list)
+    def iter_walk(self):
+        # (key list, value) tuples of all known templates, yielded as soon as a top level statement is walked
+        for _, parsed_template in self.iter_templates(self.parent_template):
+            for e in self.iter_ast(parsed_template):
+                yield e
 
-        return var_dict
+    def get_variables(self):
+        variables = VariableTrie()
+        with profiler.stage('walk_ast'):
+            for key_list, value in self.iter_walk():
+                variables.insert(key_list, value)
+
+        return variables.to_dict()
+
+    def iter_variables(self):
+        """
+        Extract variables lazily, templates are walked only as far as the caller reads.
+        :return: Generator of unique dotted variable paths, e.g. vxlan.loopback.ip or vlan_list[].number
+        """
+        known_paths = set()
+        for key_list, value in self.iter_walk():
+            for path in iter_paths(key_list, value):
+                if path not in known_paths:
+                    known_paths.add(path)
+                    yield path
+
+    def has_variable(self, path):
+        # stops walking the templates as soon as the variable is found
+        for known_path in self.iter_variables():
+            if known_path == path:
+                return True
+        return False
+
+
+def extract_variables(template_realpath):
+    # extract variables from a single template, errors are returned instead of being raised
+    try:
+        return template_realpath, J2Meta(template_realpath).get_variables(), False
+    except Exception as e:
+        return template_realpath, False, str(e) or e.__class__.__name__
+
+
+def iter_variables_batch(template_list, jobs=1):
+    """
+    Extract variables from many templates.
+    Every process keeps the default TemplateASTCache, so templates included by many parents are parsed once.
+    :param template_list: List of template file paths.
+    :param jobs: Number of worker processes. Templates are processed in the current process if 1.
+    :return: Generator of (template path, variables, error) tuples in template list order.
+    """
+    if jobs > 1 and len(template_list) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        # neighbouring templates usually share includes, so they are sent to the same worker
+        chunk_size = max(1, len(template_list) // (jobs * 4))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for e in executor.map(extract_variables, template_list, chunksize=chunk_size):
+                yield e
+    else:
+        for template_realpath in template_list:
+            yield extract_variables(template_realpath)
 
 
 if __name__ == '__main__':
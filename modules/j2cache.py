@@ -0,0 +1,81 @@
+__author__ = 'Petr Ankudinov'
+
+from collections import OrderedDict
+from modules.profiler import profiler
+import os
+import jinja2
+
+
+class CountingLoader(jinja2.FileSystemLoader):
+    # template sources are read only to compile a template or to load its bytecode, every read is a cache miss
+
+    def __init__(self, searchpath, template_cache):
+        jinja2.FileSystemLoader.__init__(self, searchpath=searchpath)
+        self.template_cache = template_cache
+
+    def get_source(self, environment, template):
+        self.template_cache.misses += 1
+        return jinja2.FileSystemLoader.get_source(self, environment, template)
+
+
+class TemplateCache:
+    """
+    Jinja2 environments and compiled templates shared across the whole run.
+    One environment is created per template search path, compiled templates are kept in a bounded LRU.
+    Environment caches are bounded by the same size, they keep templates loaded by include statements.
+    Misses count templates actually compiled or loaded from bytecode, including included templates.
+    Optionally Jinja2 bytecode is stored on disk, so repeated runs skip template compilation.
+    With auto_reload a cached template is compiled again if the file changed, that costs a stat call per request
+    and is used by long running processes only. Included templates are checked by the Jinja2 environment itself.
+    """
+
+    def __init__(self, max_size=256, bytecode_dir=False, auto_reload=False):
+        self.max_size = max_size
+        self.auto_reload = auto_reload
+        self.bytecode_cache = None
+        if bytecode_dir:
+            os.makedirs(bytecode_dir, exist_ok=True)
+            self.bytecode_cache = jinja2.FileSystemBytecodeCache(directory=bytecode_dir)
+        self.environments = dict()
+        self.templates = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.workers = dict()  # process pool worker ID: (templates, environments) in the worker cache
+
+    def get_environment(self, search_path):
+        try:
+            j2_env = self.environments[search_path]
+        except KeyError:
+            j2_env = jinja2.Environment(loader=CountingLoader(search_path, self),
+                                        bytecode_cache=self.bytecode_cache, cache_size=self.max_size,
+                                        auto_reload=self.auto_reload)
+            self.environments[search_path] = j2_env
+        return j2_env
+
+    def get_template(self, search_path, template_filename):
+        key = (search_path, template_filename)
+        try:
+            j2_template = self.templates[key]
+            if self.auto_reload and not j2_template.is_up_to_date:
+                raise KeyError(key)
+        except KeyError:
+            misses = self.misses
+            with profiler.stage('compile_template'):
+                j2_template = self.get_environment(search_path).get_template(template_filename)
+            if self.misses == misses:
+                self.hits += 1  # dropped from the LRU, but still in the environment cache
+            self.templates[key] = j2_template
+            if len(self.templates) > self.max_size:
+                self.templates.popitem(last=False)  # drop least recently used template
+        else:
+            self.hits += 1
+            self.templates.move_to_end(key)
+        return j2_template
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'templates': len(self.templates) + sum(e[0] for e in self.workers.values()),
+            'environments': len(self.environments) + sum(e[1] for e in self.workers.values()),
+        }
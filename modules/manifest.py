@@ -0,0 +1,108 @@
+__author__ = 'Petr Ankudinov'
+
+from modules.j2ASTwalker import J2Meta
+import hashlib
+import json
+import os
+
+MANIFEST_FILENAME = '.j2p-manifest.json'
+
+
+def canonical_dump(data):
+    # stable text representation of host variables used for hashing
+    try:
+        return json.dumps(data, sort_keys=True, default=str)
+    except TypeError:  # keys of different types can not be sorted
+        return repr(data)
+
+
+class Manifest:
+    """
+    Content-addressed manifest of generated configs.
+    For every host of the task the manifest keeps a digest of all render inputs and the name of the saved config.
+    Hosts with an unchanged digest and an existing config file do not have to be rendered again.
+    """
+
+    def __init__(self, configs_path, task_filename):
+        self.realpath = os.path.join(configs_path, MANIFEST_FILENAME)
+        self.configs_path = configs_path
+        self.task_key = os.path.realpath(task_filename)
+        try:
+            with open(self.realpath, mode='r') as file:
+                self.data = json.load(file)
+        except Exception as _:  # missing or broken manifest, every host will be rendered
+            self.data = dict()
+        self.hosts = dict()  # entries for the current run
+        self.template_digests = dict()
+        self.variable_digests = dict()
+
+    def template_digest(self, template_search_path, template_filename):
+        # digest of the template and all templates included by it, None if a template can not be read
+        key = (template_search_path, template_filename)
+        try:
+            return self.template_digests[key]
+        except KeyError:
+            try:
+                template_meta = J2Meta(os.path.join(template_search_path, template_filename))
+                digest = hashlib.sha256()
+                for template in sorted(template_meta.get_template_list()):
+                    template_src = template_meta.env.loader.get_source(template_meta.env, template)[0]
+                    digest.update(template.encode())
+                    digest.update(hashlib.sha256(template_src.encode()).digest())
+                self.template_digests[key] = digest.hexdigest()
+            except Exception as _:  # missing template or include, the error is reported when the host is rendered
+                self.template_digests[key] = None
+            return self.template_digests[key]
+
+    def variable_digest(self, host_variables):
+        # host variables are shared between hosts until they are merged, so digests are cached by object
+        key = id(host_variables)
+        try:
+            return self.variable_digests[key][1]
+        except KeyError:
+            digest = hashlib.sha256(canonical_dump(host_variables).encode()).hexdigest()
+            self.variable_digests[key] = (host_variables, digest)  # keep the object alive while id is in use
+            return digest
+
+    def host_digest(self, host_task, prefix):
+        # None if one of the templates can not be read
+        digest = hashlib.sha256()
+        digest.update(repr(prefix).encode())
+        for template_search_path, template_filename, host_variables in host_task:
+            template_digest = self.template_digest(template_search_path, template_filename)
+            if template_digest is None:
+                return None
+            digest.update(template_digest.encode())
+            digest.update(self.variable_digest(host_variables).encode())
+        return digest.hexdigest()
+
+    def changed(self, host, host_task, prefix):
+        """
+        Compare host inputs with the previous run.
+        :param host: Host ID.
+        :param host_task: List of (template search path, template filename, variables) tuples.
+        :param prefix: Config filename prefix.
+        :return: True if the host config has to be rendered.
+        """
+        digest = self.host_digest(host_task, prefix)
+        previous = self.data.get(self.task_key, dict()).get(str(host))
+        if digest is not None and previous and previous['digest'] == digest and \
+                os.path.isfile(os.path.join(self.configs_path, previous['file'])):
+            self.hosts[str(host)] = previous
+            return False
+        self.hosts[str(host)] = {'digest': digest, 'file': False}
+        return True
+
+    def saved(self, host, realpath):
+        self.hosts[str(host)]['file'] = os.path.basename(realpath)
+
+    def failed(self, host):
+        del self.hosts[str(host)]
+
+    def save(self):
+        # entries of hosts that are no longer part of the task are dropped
+        self.data[self.task_key] = {host: entry for host, entry in self.hosts.items() if entry['file']}
+        temp_realpath = self.realpath + '.tmp'
+        with open(temp_realpath, mode='w') as file:
+            json.dump(self.data, file, indent=1, sort_keys=True)
+        os.replace(temp_realpath, self.realpath)
@@ -0,0 +1,169 @@
+__author__ = 'Petr Ankudinov'
+
+from modules import tools
+from time import time
+import filecmp
+import io
+import json
+import os
+
+
+def remove_file(realpath):
+    # used to clean up temporary files, errors are ignored
+    try:
+        os.remove(realpath)
+    except OSError:
+        pass
+
+
+class ConfigWriter:
+    """
+    Host configs saved as separate files in the configs directory.
+    Every config is written to a temporary file and renamed, so a config file is either complete or missing.
+    Unless skip_unchanged is False, a config identical to the latest saved config of the host is not written again.
+    """
+
+    def __init__(self, configs_path, prefix=False, skip_unchanged=True):
+        self.configs_path = configs_path
+        self.prefix = prefix
+        self.skip_unchanged = skip_unchanged
+        self.latest = self.find_latest() if skip_unchanged else dict()
+        self.written = 0
+        self.unchanged = 0
+
+    def config_filename(self, host):
+        filename = ''
+        if self.prefix:
+            filename += self.prefix + '_'
+        filename += str(host) + '_' + str(tools.time_stamp()) + '.txt'
+        return os.path.join(self.configs_path, filename)
+
+    def find_latest(self):
+        # latest config of every host, found with a single directory scan
+        latest = dict()  # host: (time stamp, config realpath)
+        name_prefix = self.prefix + '_' if self.prefix else ''
+        for entry in os.scandir(self.configs_path):
+            if not entry.name.endswith('.txt') or not entry.name.startswith(name_prefix):
+                continue
+            host, _, stamp = entry.name[len(name_prefix):-len('.txt')].rpartition('_')
+            if host and (host not in latest or stamp > latest[host][0]):
+                latest[host] = (stamp, entry.path)
+        return latest
+
+    def unchanged_config(self, host, data):
+        # realpath of the latest config of the host if the content is the same, otherwise False
+        try:
+            realpath = self.latest[str(host)][1]
+            if os.path.getsize(realpath) == len(data):
+                with open(realpath, mode='rb') as file:
+                    if file.read() == data:
+                        return realpath
+        except (KeyError, OSError):
+            pass
+        return False
+
+    def write(self, host, configuration):
+        """
+        Save host config.
+        :param host: Host ID.
+        :param configuration: Rendered config.
+        :return: Tuple with config realpath and True if the file was written or False if the latest config is the same.
+        OSError is raised if the config can not be written.
+        """
+        data = configuration.encode()
+        if self.skip_unchanged:
+            realpath = self.unchanged_config(host, data)
+            if realpath:
+                self.unchanged += 1
+                return realpath, False
+        realpath = self.config_filename(host)
+        try:
+            with open(realpath + '.tmp', mode='wb') as file:
+                file.write(data)
+            os.replace(realpath + '.tmp', realpath)
+        except OSError:
+            remove_file(realpath + '.tmp')
+            raise
+        self.written += 1
+        return realpath, True
+
+    def open_temp(self, host):
+        # config realpath and a temporary file to render the config into, see commit()
+        realpath = self.config_filename(host)
+        return realpath, open(realpath + '.tmp', mode='w', encoding='utf-8')
+
+    def commit(self, host, realpath):
+        """
+        Rename the temporary file created by open_temp() after the file is closed.
+        :return: The same as write().
+        """
+        if self.skip_unchanged:
+            try:
+                latest_realpath = self.latest[str(host)][1]
+                if filecmp.cmp(latest_realpath, realpath + '.tmp', shallow=False):
+                    remove_file(realpath + '.tmp')
+                    self.unchanged += 1
+                    return latest_realpath, False
+            except (KeyError, OSError):
+                pass
+        try:
+            os.replace(realpath + '.tmp', realpath)
+        except OSError:
+            remove_file(realpath + '.tmp')
+            raise
+        self.written += 1
+        return realpath, True
+
+    def discard(self, realpath):
+        remove_file(realpath + '.tmp')
+
+    def close(self):
+        pass
+
+
+class BundleWriter:
+    """
+    All host configs of a run packed into a single JSON lines file or tar archive.
+    The bundle is written with large buffered writes to a temporary file and renamed when closed.
+    """
+
+    def __init__(self, configs_path, prefix=False, bundle_format='jsonl'):
+        filename = ''
+        if prefix:
+            filename += prefix + '_'
+        filename += 'configs_' + str(tools.time_stamp()) + '.' + bundle_format
+        self.realpath = os.path.join(configs_path, filename)
+        self.format = bundle_format
+        if self.format == 'tar':
+            import tarfile  # tar bundles only, the module is not loaded by other modes
+            self.tarinfo = tarfile.TarInfo
+            self.file = tarfile.open(self.realpath + '.tmp', mode='w')
+        else:
+            self.file = open(self.realpath + '.tmp', mode='w', encoding='utf-8', buffering=1024 * 1024)
+        self.written = 0
+        self.unchanged = 0
+
+    def write(self, host, configuration):
+        # returns the same as ConfigWriter.write(), the bundle is the config file of every host
+        if self.format == 'tar':
+            data = configuration.encode()
+            member = self.tarinfo(name=str(host) + '.txt')
+            member.size = len(data)
+            member.mtime = time()
+            self.file.addfile(member, io.BytesIO(data))
+        else:
+            self.file.write(json.dumps({'host': str(host), 'config': configuration}) + '\n')
+        self.written += 1
+        return self.realpath, True
+
+    def close(self):
+        # bundle appears in the configs directory only if it is complete and not empty
+        try:
+            self.file.close()
+            if self.written:
+                os.replace(self.realpath + '.tmp', self.realpath)
+            else:
+                remove_file(self.realpath + '.tmp')
+        except OSError:
+            remove_file(self.realpath + '.tmp')
+            raise
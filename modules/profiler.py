@@ -0,0 +1,112 @@
+__author__ = 'Petr Ankudinov'
+
+from contextlib import contextmanager
+from time import perf_counter
+import json
+import sys
+
+
+class Profiler:
+    """
+    Wall time, call count and produced bytes for every stage of a run and every rendered template.
+    Instrumented code checks the 'active' flag first, so a disabled profiler costs a single attribute lookup.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.stages = dict()  # stage name: [wall time, calls, bytes]
+        self.templates = dict()  # template name: [wall time, calls, bytes]
+
+    def start(self):
+        self.active = True
+
+    def add(self, stage, elapsed, size=0):
+        try:
+            counters = self.stages[stage]
+        except KeyError:
+            counters = self.stages[stage] = [0.0, 0, 0]
+        counters[0] += elapsed
+        counters[1] += 1
+        counters[2] += size
+
+    def add_template(self, template, elapsed, size=0):
+        try:
+            counters = self.templates[template]
+        except KeyError:
+            counters = self.templates[template] = [0.0, 0, 0]
+        counters[0] += elapsed
+        counters[1] += 1
+        counters[2] += size
+
+    @contextmanager
+    def stage(self, stage):
+        if not self.active:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, perf_counter() - start)
+
+    def pop_stats(self):
+        # return collected counters and start from scratch, used to send worker counters to the main process
+        stats = {'stages': self.stages, 'templates': self.templates}
+        self.stages = dict()
+        self.templates = dict()
+        return stats
+
+    def merge_stats(self, stats):
+        for target, source in [(self.stages, stats['stages']), (self.templates, stats['templates'])]:
+            for name, (elapsed, calls, size) in source.items():
+                try:
+                    counters = target[name]
+                except KeyError:
+                    counters = target[name] = [0.0, 0, 0]
+                counters[0] += elapsed
+                counters[1] += calls
+                counters[2] += size
+
+    def summary(self):
+        lines = list()
+        for title, counters in [('stage', self.stages), ('template', self.templates)]:
+            if not counters:
+                continue
+            lines.append('%-32s %10s %10s %12s' % (title, 'time, s', 'calls', 'bytes'))
+            for name, (elapsed, calls, size) in sorted(counters.items(), key=lambda e: e[1][0], reverse=True):
+                lines.append('%-32s %10.4f %10d %12d' % (name, elapsed, calls, size))
+        return '\n'.join(lines)
+
+    def dump(self, filename):
+        with open(filename, mode='w') as file:
+            json.dump({
+                'stages': {name: {'time': e[0], 'calls': e[1], 'bytes': e[2]} for name, e in self.stages.items()},
+                'templates': {name: {'time': e[0], 'calls': e[1], 'bytes': e[2]} for name, e in self.templates.items()},
+            }, file, indent=1, sort_keys=True)
+
+
+profiler = Profiler()  # shared by all modules, enabled with j2p.py --profile
+
+
+def run_profiled(function, output=False):
+    """
+    Run a function with the profiler enabled and print the summary to stderr.
+    :param function: Function without arguments.
+    :param output: Optional filename. Stage counters are saved as JSON, or cProfile stats if filename ends with .prof
+    :return: Function result.
+    """
+    profiler.start()
+    if output and output.endswith('.prof'):
+        import cProfile
+        c_profile = cProfile.Profile()
+        try:
+            return c_profile.runcall(function)
+        finally:
+            c_profile.dump_stats(output)
+            print(profiler.summary(), file=sys.stderr)
+    try:
+        return function()
+    finally:
+        print(profiler.summary(), file=sys.stderr)
+        if output:
+            profiler.dump(output)
@@ -0,0 +1,331 @@
+__author__ = 'Petr Ankudinov'
+
+from contextlib import asynccontextmanager
+from time import perf_counter
+import asyncio
+import base64
+import json
+import random
+import ssl
+import sys
+
+
+class PushError(Exception):
+    # configuration was rejected by the device, retry will not help
+    pass
+
+
+RETRY_ERRORS = (OSError, EOFError, asyncio.TimeoutError)  # connection problems, push is retried
+
+
+def config_commands(configuration):
+    # configuration lines without empty lines and comments
+    return [line.rstrip() for line in configuration.splitlines() if line.strip() and not line.lstrip().startswith('!')]
+
+
+class EAPITransport:
+    """
+    Arista eAPI client. JSON-RPC runCmds requests are sent over a single HTTP/1.1 keep-alive connection.
+    """
+
+    def __init__(self, host, settings):
+        self.host = host
+        self.https = settings.get('https', True)
+        self.port = settings.get('port', 443 if self.https else 80)
+        self.path = settings.get('path', '/command-api')
+        self.verify = settings.get('verify', True)
+        credentials = '%s:%s' % (settings.get('username', 'admin'), settings.get('password', ''))
+        self.authorization = 'Basic ' + base64.b64encode(credentials.encode()).decode()
+        self.reader = None
+        self.writer = None
+        self.request_id = 0
+
+    @staticmethod
+    def check():
+        # standard library only
+        return False
+
+    def is_open(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+        ssl_context = None
+        if self.https:
+            ssl_context = ssl.create_default_context()
+            if not self.verify:
+                ssl_context.check_hostname = False
+                ssl_context.verify_mode = ssl.CERT_NONE
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=ssl_context)
+
+    async def read_response(self):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by %s.' % self.host)
+        try:
+            status = int(status_line.split()[1])
+        except (ValueError, IndexError):
+            raise PushError('Not a HTTP response: %s' % status_line.decode('latin-1').strip())
+        headers = dict()
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = list()
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if not size:
+                    await self.reader.readline()
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await self.reader.readexactly(int(headers['content-length']))
+        else:
+            body = await self.reader.read()  # response ends when the connection is closed
+            headers['connection'] = 'close'
+        return status, headers, body
+
+    async def run(self, commands):
+        self.request_id += 1
+        body = json.dumps({'jsonrpc': '2.0', 'method': 'runCmds', 'id': self.request_id,
+                           'params': {'version': 1, 'cmds': ['enable'] + commands, 'format': 'json'}}).encode()
+        header = 'POST %s HTTP/1.1\r\nHost: %s\r\nAuthorization: %s\r\nContent-Type: application/json\r\n' \
+                 'Content-Length: %d\r\nConnection: keep-alive\r\n\r\n' % (self.path, self.host, self.authorization,
+                                                                            len(body))
+        self.writer.write(header.encode() + body)
+        await self.writer.drain()
+        status, headers, body = await self.read_response()
+        if headers.get('connection', '').lower() == 'close':
+            await self.close()
+        if status >= 500:
+            raise ConnectionError('HTTP error %d.' % status)
+        if status != 200:
+            raise PushError('HTTP error %d.' % status)
+        try:
+            response = json.loads(body.decode())
+        except ValueError:  # JSONDecodeError and UnicodeDecodeError
+            raise PushError('Not a JSON-RPC response.')
+        if 'error' in response:
+            raise PushError(response['error'].get('message', 'Command failed.'))
+        return response.get('result')
+
+    async def push(self, commands):
+        return await self.run(['configure'] + commands + ['end'])
+
+    async def close(self):
+        if self.writer is not None:
+            writer = self.writer
+            self.writer = None
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception as _:
+                pass
+
+
+class SSHTransport:
+    """
+    SSH client based on asyncssh. Commands are sent to the device shell as input of a single session.
+    asyncssh is optional and imported when the push engine is created.
+    """
+
+    def __init__(self, host, settings):
+        self.host = host
+        self.options = {
+            'port': settings.get('port', 22),
+            'username': settings.get('username', 'admin'),
+            'password': settings.get('password', ''),
+        }
+        if 'known_hosts' in settings:
+            self.options['known_hosts'] = settings['known_hosts']  # None disables host key check
+        self.connection = None
+
+    @staticmethod
+    def check():
+        # returns an error message if the optional dependency is missing
+        try:
+            import asyncssh
+        except ImportError:
+            return 'asyncssh is required for ssh transport.'
+        return False
+
+    def is_open(self):
+        return self.connection is not None
+
+    async def connect(self):
+        import asyncssh
+        self.connection = await asyncssh.connect(self.host, **self.options)
+
+    async def run(self, commands):
+        result = await self.connection.run(input='\n'.join(commands) + '\n')
+        errors = [line for line in (result.stdout or '').splitlines() if line.startswith('% ')]
+        if errors:
+            raise PushError(' '.join(errors))
+        return result.stdout
+
+    async def push(self, commands):
+        return await self.run(['configure'] + commands + ['end'])
+
+    async def close(self):
+        if self.connection is not None:
+            connection = self.connection
+            self.connection = None
+            connection.close()
+            try:
+                await connection.wait_closed()
+            except Exception as _:
+                pass
+
+
+TRANSPORTS = {
+    'eapi': EAPITransport,
+    'ssh': SSHTransport,
+}
+
+
+class ConnectionPool:
+    """
+    Open connections kept per host and reused by following requests.
+    Number of connections to a single host is limited, failed connections are closed and never reused.
+    """
+
+    def __init__(self, transport_class, settings, connections_per_host=1):
+        self.transport_class = transport_class
+        self.settings = settings
+        self.connections_per_host = connections_per_host
+        self.idle = dict()  # host: list of open transports
+        self.limits = dict()  # host: semaphore
+        self.opened = 0
+        self.reused = 0
+
+    @asynccontextmanager
+    async def connection(self, host, timeout):
+        try:
+            limit = self.limits[host]
+        except KeyError:
+            limit = self.limits[host] = asyncio.Semaphore(self.connections_per_host)
+        async with limit:
+            idle = self.idle.setdefault(host, list())
+            transport = None
+            while idle and transport is None:
+                transport = idle.pop()
+                if not transport.is_open():
+                    transport = None
+            if transport is None:
+                transport = self.transport_class(host, self.settings)
+                try:
+                    await asyncio.wait_for(transport.connect(), timeout)
+                except BaseException:
+                    await transport.close()
+                    raise
+                self.opened += 1
+            else:
+                self.reused += 1
+            try:
+                yield transport
+            except BaseException:
+                await transport.close()  # state of the connection is unknown after a failure
+                raise
+            if transport.is_open():
+                idle.append(transport)
+
+    async def close(self):
+        for idle in self.idle.values():
+            for transport in idle:
+                await transport.close()
+        self.idle = dict()
+
+
+class PushEngine:
+    """
+    Push rendered configs to many devices at once.
+    Number of hosts in progress is bounded, connection problems are retried with exponential backoff.
+    Settings are taken from the 'delivery' section of settings.yaml:
+    transport, concurrency, retries, backoff, timeout, connections_per_host, commit_commands and transport options.
+    """
+
+    def __init__(self, settings):
+        try:
+            transport_class = TRANSPORTS[settings.get('transport', 'eapi')]
+        except KeyError:
+            sys.exit('ERROR: Unknown transport %s!' % settings.get('transport'))
+        error = transport_class.check()
+        if error:
+            sys.exit('ERROR: ' + error)
+        self.concurrency = settings.get('concurrency', 100)
+        self.retries = settings.get('retries', 2)
+        self.backoff = settings.get('backoff', 0.5)
+        self.timeout = settings.get('timeout', 30)
+        self.commit_commands = settings.get('commit_commands', list())  # sent over the same connection after push
+        self.requests = 0
+        self.pool = ConnectionPool(transport_class, settings, connections_per_host=settings.get(
+            'connections_per_host', 1))
+
+    async def push_host(self, host, configuration):
+        """
+        Push a config to a single host.
+        :param host: Host address.
+        :param configuration: Rendered config.
+        :return: Dictionary with host, ok, error, attempts, commands and elapsed time in seconds.
+        """
+        commands = config_commands(configuration)
+        start = perf_counter()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                async with self.pool.connection(host, self.timeout) as transport:
+                    self.requests += 1
+                    await asyncio.wait_for(transport.push(commands), self.timeout)
+                    if self.commit_commands:
+                        self.requests += 1
+                        await asyncio.wait_for(transport.run(list(self.commit_commands)), self.timeout)
+            except PushError as e:
+                error = str(e)
+                break
+            except RETRY_ERRORS as e:
+                error = str(e) or e.__class__.__name__
+                if attempt > self.retries:
+                    break
+                # random factor spreads reconnects to the same host
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1) * (0.5 + random.random()))
+            except Exception as e:
+                # unexpected transport error fails this host only, other pushes continue
+                error = '%s: %s' % (e.__class__.__name__, e) if str(e) else e.__class__.__name__
+                break
+            else:
+                error = False
+                break
+        return {
+            'host': host,
+            'ok': not error,
+            'error': error,
+            'attempts': attempt,
+            'commands': len(commands),
+            'elapsed': perf_counter() - start,
+        }
+
+    async def push_all(self, configs):
+        """
+        Push configs to all hosts.
+        :param configs: List of (host, config) tuples.
+        :return: List of push_host() results in the same order.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def push_limited(host, configuration):
+            async with semaphore:
+                return await self.push_host(host, configuration)
+
+        try:
+            return await asyncio.gather(*[push_limited(host, configuration) for host, configuration in configs])
+        finally:
+            await self.pool.close()
+
+    def run(self, configs):
+        # push_all() in an event loop created for this call
+        return asyncio.run(self.push_all(configs))
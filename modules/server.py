@@ -0,0 +1,232 @@
+__author__ = 'Petr Ankudinov'
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
+from urllib.parse import urlsplit, parse_qs, unquote
+from modules import tools, delivery
+from modules.hostdb import HostDB
+from modules.j2cache import TemplateCache
+from modules.j2ASTwalker import J2Meta
+from time import perf_counter, monotonic
+import threading
+import signal
+import json
+import yaml
+import os
+import sys
+
+
+class TaskEnvironment:
+    # task data in the form expected by delivery.build_host_tasks()
+
+    def __init__(self, json_db, json_data, template_path):
+        self.json_db = json_db
+        self.json_data = json_data
+        self.template_path = template_path
+
+
+class RenderService:
+    """
+    Host db, task files, host variables and compiled templates loaded once and kept in memory.
+    Files are reloaded when their modification time changes. Requests are served one at a time.
+    """
+
+    def __init__(self, env, check_interval=0):
+        self.template_path = env.template_path
+        self.task_path = env.task_path
+        self.yaml_cache = env.yaml_cache
+        self.db_name = env.db_name
+        self.db_mtime = os.path.getmtime(self.db_name)
+        self.json_db = env.json_db
+        self.default_task = os.path.realpath(env.filename)
+        self.template_cache = TemplateCache(max_size=env.template_cache_size, bytecode_dir=env.bytecode_cache,
+                                            auto_reload=True)
+        self.check_interval = check_interval  # seconds between file modification checks
+        self.last_check = monotonic()
+        self.tasks = dict()  # task realpath: (mtime, host tasks)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.reloads = 0
+
+    def check_files(self):
+        # drop data loaded from changed files
+        if self.check_interval and monotonic() - self.last_check < self.check_interval:
+            return
+        self.last_check = monotonic()
+        mtime = os.path.getmtime(self.db_name)
+        if mtime != self.db_mtime:
+            json_db = tools.load_yaml(self.db_name, cache_dir=self.yaml_cache)
+            if not isinstance(json_db, dict):
+                raise ValueError('Wrong db format. Database file should be a dictionary!')
+            self.json_db = HostDB(json_db)
+            self.db_mtime = mtime
+            self.tasks = dict()
+            self.reloads += 1
+        for task_realpath, (mtime, _) in list(self.tasks.items()):
+            if not os.path.isfile(task_realpath) or os.path.getmtime(task_realpath) != mtime:
+                del self.tasks[task_realpath]
+                self.reloads += 1
+
+    def get_task_filename(self, task_name):
+        if not task_name:
+            return self.default_task
+        filename = os.path.realpath(os.path.join(self.task_path, task_name))
+        if not filename.startswith(os.path.realpath(self.task_path) + os.sep) or not os.path.isfile(filename):
+            raise LookupError('Can not find task %s!' % task_name)
+        return filename
+
+    def get_host_tasks(self, task_name=False):
+        task_realpath = self.get_task_filename(task_name)
+        try:
+            return self.tasks[task_realpath][1]
+        except KeyError:
+            mtime = os.path.getmtime(task_realpath)
+            json_data = tools.load_yaml(task_realpath, cache_dir=self.yaml_cache)
+            if not isinstance(json_data, list):
+                raise ValueError('Wrong task format %s!' % task_name)
+            host_tasks = delivery.build_host_tasks(TaskEnvironment(self.json_db, json_data, self.template_path))
+            self.tasks[task_realpath] = (mtime, host_tasks)
+            return host_tasks
+
+    def warm_up(self):
+        # load the default task and compile all templates it uses
+        templates = set()
+        for host_task in self.get_host_tasks().values():
+            for template_search_path, template_filename, _ in host_task:
+                templates.add((template_search_path, template_filename))
+        for template_search_path, template_filename in sorted(templates):
+            self.template_cache.get_template(template_search_path, template_filename)
+        return len(templates)
+
+    def render(self, host, task_name=False):
+        """
+        Render config for a single host.
+        :param host: Host ID from the host db.
+        :param task_name: Task filename relative to the task directory. Task from CLI is used if not specified.
+        :return: Config, the same as saved by save mode.
+        """
+        with self.lock:
+            self.requests += 1
+            self.check_files()
+            try:
+                host_task = self.get_host_tasks(task_name)[host]
+            except KeyError:
+                raise LookupError('No templates assigned to host %s!' % host)
+            return delivery.render_host(self.template_cache, host_task)
+
+    def variables(self, template_name):
+        """
+        Extract variables from a template.
+        :param template_name: Template filename relative to the template directory.
+        :return: Variable dictionary.
+        """
+        filename = os.path.realpath(os.path.join(self.template_path, template_name))
+        if not filename.startswith(os.path.realpath(self.template_path) + os.sep) or not os.path.isfile(filename):
+            raise LookupError('Can not find template %s!' % template_name)
+        with self.lock:
+            self.requests += 1
+            return J2Meta(filename).get_variables()  # parsed templates are kept in the default AST cache
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                'requests': self.requests,
+                'reloads': self.reloads,
+                'hosts': len(self.json_db),
+                'tasks': len(self.tasks),
+            }
+            stats.update({'template_cache_' + key: value for key, value in self.template_cache.stats().items()})
+            return stats
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /render/<host>[?task=<task file>] - rendered config as text.
+    GET /variables/<template>[?format=yaml] - template variables as JSON or YAML.
+    GET /stats - request and cache counters as JSON.
+    """
+    protocol_version = 'HTTP/1.1'  # keep-alive, clients can reuse the connection
+    disable_nagle_algorithm = True  # headers and body are written separately, do not wait for delayed ACK
+    service = None  # RenderService, set by serve()
+
+    def send(self, code, body, content_type='text/plain'):
+        body = body.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        endpoint, _, argument = url.path.lstrip('/').partition('/')
+        argument = unquote(argument)
+        try:
+            if endpoint == 'render' and argument:
+                self.send(200, self.service.render(argument, query.get('task', [False])[0]))
+            elif endpoint == 'variables' and argument:
+                variables = self.service.variables(argument)
+                if query.get('format', ['json'])[0] == 'yaml':
+                    self.send(200, yaml.dump(variables, default_flow_style=False), content_type='application/yaml')
+                else:
+                    self.send(200, json.dumps(variables, sort_keys=True, default=str), 'application/json')
+            elif endpoint == 'stats':
+                self.send(200, json.dumps(self.service.stats(), sort_keys=True), 'application/json')
+            else:
+                self.send(404, json.dumps({'error': 'Unknown request %s' % url.path}), 'application/json')
+        except LookupError as e:
+            self.send(404, json.dumps({'error': str(e)}), 'application/json')
+        except Exception as e:
+            self.send(500, json.dumps({'error': str(e) or e.__class__.__name__}), 'application/json')
+
+    def address_string(self):
+        # client address is empty for Unix sockets
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class UnixHTTPServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)  # socket left by a previous run
+        super().server_bind()
+
+
+def serve(env):
+    """
+    Run render service until interrupted.
+    :param env: Script environment. Server listens on env.unix_socket if set, otherwise on env.bind (host:port).
+    :return: None
+    """
+    service = RenderService(env, check_interval=env.check_interval)
+    start = perf_counter()
+    template_count = service.warm_up()
+    handler = type('ServiceRequestHandler', (RequestHandler,), {
+        'service': service,
+        'disable_nagle_algorithm': not env.unix_socket,  # TCP option
+    })
+    if env.unix_socket:
+        server = UnixHTTPServer(env.unix_socket, handler)
+        address = env.unix_socket
+    else:
+        host, _, port = env.bind.rpartition(':')
+        server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), handler)
+        address = '%s:%d' % server.server_address[:2]
+    server.verbose = env.verbose
+    print('Serving %d host(s), %d template(s) compiled in %.3f s, listening on %s' % (
+        len(service.get_host_tasks()), template_count, perf_counter() - start, address), file=sys.stderr)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # close the server and remove the socket
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if env.unix_socket and os.path.exists(env.unix_socket):
+            os.remove(env.unix_socket)
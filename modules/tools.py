@@ -1,61 +1,94 @@
 import yaml
+import os
+import pickle
+import hashlib
+from modules.profiler import profiler
 from time import time as time                   # used in: time_stamp()
 from datetime import datetime as datetime       # used in: time_stamp()
 
 __author__ = 'Petr Ankudinov'
 
+try:
+    from yaml import CSafeLoader as YAMLLoader  # libyaml based loader, much faster
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader
 
-def merge_dict(d1, d2):
+
+def merge_dict(d1, d2, in_place=False, owned=None):
     """
     Merge 2 dictionaries together, keeping every element with unique key sequence.
-    Relies on recursion.
+    Nested dictionaries are merged with an explicit stack. Subtrees present in one dictionary only are shared
+    with the result, merged subtrees are copied before being modified.
     :param d1: Primary dictionary.
     :param d2: Secondary dictionary. If element is already present in d1, conflicting element from d1 will be replaced.
+    :param in_place: Update d1 and return it instead of creating a new dictionary. Only the top level of d1 and
+    nested dictionaries in owned are modified.
+    :param owned: Dictionary with id() of dictionaries created by previous merges as keys and the dictionaries as
+    values. These dictionaries are not shared with anything else and are modified in place, dictionaries created
+    by this call are added. Keep it for repeated merges into the same accumulator, values keep ids from being reused.
     :return: Combined dictionary. All elements from d1 and elements from d2 if missing in d1.
     """
-    result = dict()
-    all_keys = set(d1.keys()).union(d2.keys())
-    for key in all_keys:
-        if key not in d1.keys():
-            result[key] = d2[key]
-        elif key not in d2.keys():
-            result[key] = d1[key]
-        else:
-            if isinstance(d1[key], dict) and isinstance(d2[key], dict):
-                    result[key] = merge_dict(d1[key], d2[key])  # recursion
-            elif isinstance(d1[key], list) or isinstance(d2[key], list):
-                temp_set = set()
-                temp_dict = dict()
-
-                if isinstance(d1[key], dict):
-                    temp_dict = merge_dict(temp_dict, d1[key])  # recursion
-                if isinstance(d2[key], dict):
-                    temp_dict = merge_dict(temp_dict, d2[key])  # recursion
-
-                if isinstance(d1[key], list):
-                    for e1 in d1[key]:
-                        if isinstance(e1, dict):
-                            temp_dict = merge_dict(temp_dict, e1)  # recursion
-                        else:
-                            temp_set.add(e1)
-
-                if isinstance(d2[key], list):
-                    for e2 in d2[key]:
-                        if isinstance(e2, dict):
-                            temp_dict = merge_dict(temp_dict, e2)  # recursion
-                        else:
-                            temp_set.add(e2)
-
-                result[key] = list()
-                result[key].append(temp_dict)
-                for e in temp_set:
-                    result[key].append(e)
+    if owned is None:
+        owned = dict()
+    if in_place:
+        result = d1
+    else:
+        result = dict(d1)
+        owned[id(result)] = result
+    stack = [(result, d2)]
+    while stack:
+        target, source = stack.pop()
+        for key, value in source.items():
+            try:
+                current = target[key]
+            except KeyError:
+                target[key] = value
+                continue
+            if isinstance(current, dict) and isinstance(value, dict):
+                if id(current) not in owned:
+                    current = dict(current)  # copy on write, current can be shared with other dictionaries
+                    owned[id(current)] = current
+                    target[key] = current
+                stack.append((current, value))
+            elif isinstance(current, list) or isinstance(value, list):
+                target[key] = merge_list(current, value)
             else:
-                result[key] = d2[key]
+                target[key] = value
 
     return result
 
 
+def merge_list(v1, v2):
+    """
+    Merge 2 values if at least one of them is a list.
+    :param v1: Primary value.
+    :param v2: Secondary value.
+    :return: List with a dictionary merged from all dictionaries in v1 and v2, followed by unique other list elements
+    in order of appearance.
+    """
+    temp_scalars = dict()  # dictionary keys are unique and keep insertion order, set order changes between runs
+    temp_dict = dict()
+    owned = {id(temp_dict): temp_dict}
+
+    if isinstance(v1, dict):
+        merge_dict(temp_dict, v1, in_place=True, owned=owned)
+    if isinstance(v2, dict):
+        merge_dict(temp_dict, v2, in_place=True, owned=owned)
+
+    for value in (v1, v2):
+        if isinstance(value, list):
+            for e in value:
+                if isinstance(e, dict):
+                    merge_dict(temp_dict, e, in_place=True, owned=owned)
+                else:
+                    temp_scalars[e] = None
+
+    result = list()
+    result.append(temp_dict)
+    result.extend(temp_scalars)
+    return result
+
+
 def build_dict(key_list, value):
     """
     Build a hierarchical dictionary with a single element from the list of keys and a value.
@@ -72,21 +105,65 @@ def build_dict(key_list, value):
         return value
 
 
-def load_yaml(filename):
-    # can be used to check if file is YAML as well
+def yaml_cache_filename(cache_dir, realpath):
+    return os.path.join(cache_dir, hashlib.sha1(realpath.encode()).hexdigest() + '.pickle')
+
+
+def load_yaml_cache(cache_dir, realpath, file_stat):
+    # returns cached data if the file size and mtime did not change, otherwise None
+    try:
+        with open(yaml_cache_filename(cache_dir, realpath), mode='rb') as file:
+            size, mtime, yaml_data = pickle.load(file)
+    except Exception as _:
+        return None
+    if size == file_stat.st_size and mtime == file_stat.st_mtime_ns:
+        return yaml_data
+    return None
+
+
+def save_yaml_cache(cache_dir, realpath, file_stat, yaml_data):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_filename = yaml_cache_filename(cache_dir, realpath)
+        with open(cache_filename + '.tmp', mode='wb') as file:
+            pickle.dump((file_stat.st_size, file_stat.st_mtime_ns, yaml_data), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_filename + '.tmp', cache_filename)
+    except Exception as _:
+        pass  # cache is optional
+
+
+def load_yaml(filename, cache_dir=False):
+    """
+    Load YAML file with libyaml based loader if available.
+    Can be used to check if file is YAML as well.
+    :param filename: YAML filename.
+    :param cache_dir: Optional directory to keep parsed data. Data is reused while file size and mtime are the same.
+    :return: Parsed data or False if the file is not a valid YAML.
+    """
     try:
         file = open(filename, mode='r')
     except Exception as _:
         print('ERROR: Can not open ', filename)
         raise SystemExit(0)
     else:
-        try:
-            yaml_data = yaml.load(file)
+        with profiler.stage('load_yaml'):
+            yaml_data = None
+            if cache_dir:
+                realpath = os.path.realpath(filename)
+                file_stat = os.fstat(file.fileno())
+                yaml_data = load_yaml_cache(cache_dir, realpath, file_stat)
+            if yaml_data is None:
+                try:
+                    yaml_data = yaml.load(file, Loader=YAMLLoader)
+                except Exception as _:
+                    file.close()
+                    return False
+                if cache_dir:
+                    save_yaml_cache(cache_dir, realpath, file_stat, yaml_data)
             file.close()
-        except Exception as _:
-            return False
-        else:
-            return yaml_data
+        if profiler.active:
+            profiler.stages['load_yaml'][2] += os.path.getsize(filename)
+        return yaml_data
 
 
 def time_stamp():
@@ -0,0 +1,177 @@
+__author__ = 'Petr Ankudinov'
+
+from modules import delivery
+from modules.j2ASTwalker import J2Meta, builtin_names, value_dict
+from modules.profiler import profiler
+import json
+import os
+import sys
+
+
+def required_paths(variables, prefix=''):
+    """
+    Variables a template needs, from the dictionary returned by J2Meta.get_variables().
+    Variables assigned inside the template have other values than 'not defined' and are skipped,
+    names used after the assignment are filtered by template_required_paths().
+    :param variables: Variable dictionary.
+    :param prefix: Path of the dictionary.
+    :return: Generator of dotted variable paths, list elements are marked with [].
+    """
+    for key, value in variables.items():
+        path = prefix + str(key)
+        if isinstance(value, dict):
+            for e in required_paths(value, path + '.'):
+                yield e
+        elif isinstance(value, list):
+            for element in value:
+                if isinstance(element, dict):
+                    for e in required_paths(element, path + '[].'):
+                        yield e
+                elif element == value_dict['not defined']:
+                    yield path + '[]'
+        elif value == value_dict['not defined']:
+            yield path
+
+
+def template_required_paths(template_meta):
+    """
+    Variables a template and all templates included by it need from the host.
+    Names defined inside the templates (set and for targets, macros, imports) and Jinja2 builtins like loop
+    or range are skipped. Variables used under an if statement or in a conditionally included template
+    are required as well, the condition is not evaluated.
+    :param template_meta: J2Meta instance.
+    :return: Sorted list of dotted variable paths.
+    """
+    local_names = template_meta.get_local_names() | builtin_names
+    return sorted(path for path in set(required_paths(template_meta.get_variables()))
+                  if path_keys(path)[0] not in local_names)
+
+
+def path_keys(path):
+    # dotted variable path as a tuple of keys, list elements are marked with a [] key
+    keys = list()
+    for key in path.split('.'):
+        if key.endswith('[]'):
+            keys.extend([key[:-2], '[]'])
+        else:
+            keys.append(key)
+    return tuple(keys)
+
+
+def has_path(value, keys, position=0):
+    """
+    Check if a variable path is defined.
+    :param value: Variable dictionary or a value inside of it.
+    :param keys: Path keys, see path_keys().
+    :param position: Number of keys already checked.
+    :return: True if the path is defined. A list element path is defined if every list element has it,
+    paths below an empty list are never rendered and always defined.
+    """
+    while position < len(keys):
+        key = keys[position]
+        position += 1
+        if key == '[]':
+            if not isinstance(value, list):
+                return False
+            if position == len(keys):
+                return True
+            for element in value:
+                if not isinstance(element, dict) or not has_path(element, keys, position):
+                    return False
+            return True
+        if not isinstance(value, dict):
+            return False
+        try:
+            value = value[key]
+        except KeyError:
+            return False
+    return True
+
+
+class Validator:
+    """
+    Compare host variables with the variables required by host templates without rendering.
+    Required paths are extracted once for every template and looked up in host variables, so only the part
+    of the variable tree used by the template is visited. Hosts of the same class share the task list
+    and are checked once.
+    """
+
+    def __init__(self):
+        self.templates = dict()  # template search path, filename: list of (required path, path keys) tuples
+        self.checks = 0
+
+    def template_paths(self, template_search_path, template_filename):
+        try:
+            return self.templates[(template_search_path, template_filename)]
+        except KeyError:
+            template_meta = J2Meta(os.path.join(template_search_path, template_filename))
+            paths = [(path, path_keys(path)) for path in template_required_paths(template_meta)]
+            self.templates[(template_search_path, template_filename)] = paths
+            return paths
+
+    def check(self, host_task):
+        """
+        Find missing variables for a host task.
+        :param host_task: List of (template search path, template filename, variables) tuples.
+        :return: Dictionary with template filenames as keys and sorted lists of missing paths as values.
+        Templates without missing variables are not included.
+        """
+        self.checks += 1
+        gaps = dict()
+        for template_search_path, template_filename, host_variables in host_task:
+            missing = [path for path, keys in self.template_paths(template_search_path, template_filename)
+                       if not has_path(host_variables or dict(), keys)]
+            if missing:
+                gaps[template_filename] = sorted(set(gaps.get(template_filename, list()) + missing))
+        return gaps
+
+    def iter_gaps(self, host_tasks):
+        """
+        Check all hosts.
+        :param host_tasks: Dictionary with host IDs as keys and host tasks as values.
+        :return: Generator of (host ID, gaps, error) tuples in host task order.
+        """
+        results = dict()  # id of host task: (gaps, error)
+        for host, host_task in host_tasks.items():
+            try:
+                gaps, error = results[id(host_task)]
+            except KeyError:
+                try:
+                    gaps, error = self.check(host_task), False
+                except Exception as e:
+                    gaps, error = dict(), 'Not able to extract variables: %s' % (str(e) or e.__class__.__name__)
+                results[id(host_task)] = (gaps, error)
+            yield host, gaps, error
+
+
+def validate_task(env):
+    """
+    Report hosts with variables missing for their templates.
+    :param env: Script environment.
+    :return: None
+    """
+    with profiler.stage('build_host_tasks'):
+        host_tasks = delivery.build_host_tasks(env)
+
+    validator = Validator()
+    failed = 0
+    report = dict()
+    with profiler.stage('validate'):
+        for host, gaps, error in validator.iter_gaps(host_tasks):
+            if error:
+                failed += 1
+                print('ERROR: %s: %s' % (host, error), file=sys.stderr)
+                report[host] = {'error': error}
+            elif gaps:
+                failed += 1
+                for template_filename, missing in sorted(gaps.items()):
+                    print('ERROR: %s: %s: %s' % (host, template_filename, ', '.join(missing)), file=sys.stderr)
+                report[host] = gaps
+    print('Validate: %d host(s) in %d class(es), %d template(s), %d host(s) with missing variables.' % (
+        len(host_tasks), validator.checks, len(validator.templates), failed), file=sys.stderr)
+
+    if env.report:
+        with open(env.report, mode='w') as file:
+            json.dump(report, file, indent=1, sort_keys=True)
+    if failed:
+        sys.exit('ERROR: Missing variables for %d host(s)!' % failed)